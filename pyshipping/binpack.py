@@ -13,8 +13,8 @@ else:
     from . import binpack_simple
 
 
-def binpack(packages, bin=None, iterlimit=5000):
-    return binpack_simple.binpack(packages, bin, iterlimit)
+def binpack(packages, bin=None, iterlimit=5000, maxweight=None):
+    return binpack_simple.binpack(packages, bin, iterlimit, maxweight)
 
 
 def test(func):
@@ -37,15 +37,17 @@ Copyright (c) 2010 HUDORA. All rights reserved.
 """
 
 
+import math
 import time
 import random
 
 
-def packstrip(bin, p):
+def packstrip(bin, p, weightleft=None):
     """Creates a Strip which fits into bin.
 
     Returns the Packages to be used in the strip, the dimensions of the strip as a 3-tuple
-    and a list of "left over" packages.
+    and a list of "left over" packages. If weightleft is given, packages which would make the strip
+    heavier than weightleft are left over as well.
     """
     # This code is somewhat optimized and somewhat unreadable
     s = []                # strip
@@ -55,29 +57,50 @@ def packstrip(bin, p):
     sapp = s.append       # speedup
     rapp = r.append       # speedup
     ppop = p.pop          # speedup
-    while p and (ss <= bs):
-        n = ppop(0)
-        nh, nw, nl = n.size
-        if ss + nh <= bs:
-            ss += nh
-            sapp(n)
-            if nw > sw:
-                sw = nw
-            if nl > sl:
-                sl = nl
-        else:
-            rapp(n)
+    if weightleft is None:
+        while p and (ss <= bs):
+            n = ppop(0)
+            nh, nw, nl = n.size
+            if ss + nh <= bs:
+                ss += nh
+                sapp(n)
+                if nw > sw:
+                    sw = nw
+                if nl > sl:
+                    sl = nl
+            else:
+                rapp(n)
+    else:
+        while p and (ss <= bs):
+            n = ppop(0)
+            nh, nw, nl = n.size
+            nweight = n.weight or 0
+            if ss + nh <= bs and nweight <= weightleft:
+                ss += nh
+                weightleft -= nweight
+                sapp(n)
+                if nw > sw:
+                    sw = nw
+                if nl > sl:
+                    sl = nl
+            else:
+                rapp(n)
     return s, (ss, sw, sl), r + p
 
 
-def packlayer(bin, packages):
+def packageweight(packages):
+    """Returns the summed weight of packages, packages without a weight count as 0."""
+    return sum([package.weight or 0 for package in packages])
+
+
+def packlayer(bin, packages, weightleft=None):
     strips = []
     layersize = 0
     layerx = 0
     layery = 0
     binsize = bin.width
     while packages:
-        strip, (sizex, stripsize, sizez), rest = packstrip(bin, packages)
+        strip, (sizex, stripsize, sizez), rest = packstrip(bin, packages, weightleft)
         if layersize + stripsize <= binsize:
             packages = rest
             if not strip:
@@ -87,6 +110,8 @@ def packlayer(bin, packages):
             layerx = max([sizex, layerx])
             layery = max([sizez, layery])
             strips.extend(strip)
+            if weightleft is not None:
+                weightleft -= packageweight(strip)
         else:
             # Next Layer please
             packages = strip + rest
@@ -94,15 +119,16 @@ def packlayer(bin, packages):
     return strips, (layerx, layersize, layery), packages
 
 
-def packbin(bin, packages):
+def packbin(bin, packages, maxweight=None):
     packages.sort()
     layers = []
     contentheigth = 0
     contentx = 0
     contenty = 0
     binsize = bin.length
+    weightleft = maxweight
     while packages:
-        layer, (sizex, sizey, layersize), rest = packlayer(bin, packages)
+        layer, (sizex, sizey, layersize), rest = packlayer(bin, packages, weightleft)
         if contentheigth + layersize <= binsize:
             packages = rest
             if not layer:
@@ -112,6 +138,8 @@ def packbin(bin, packages):
             contentx = max([contentx, sizex])
             contenty = max([contenty, sizey])
             layers.extend(layer)
+            if weightleft is not None:
+                weightleft -= packageweight(layer)
         else:
             # Next Bin please
             packages = layer + rest
@@ -119,11 +147,11 @@ def packbin(bin, packages):
     return layers, (contentx, contenty, contentheigth), packages
 
 
-def packit(bin, originalpackages):
+def packit(bin, originalpackages, maxweight=None):
     packedbins = []
     packages = sorted(originalpackages)
     while packages:
-        packagesinbin, (binx, biny, binz), rest = packbin(bin, packages)
+        packagesinbin, (binx, biny, binz), rest = packbin(bin, packages, maxweight)
         if not packagesinbin:
             # we were not able to pack anything
             break
@@ -167,7 +195,7 @@ def allpermutations_helper(permuted, todo, maxcounter, callback, bin, bestpack,
         others = todo[1:]
         thispackage = todo[0]
         for dimensions in set(permutations((thispackage[0], thispackage[1], thispackage[2]))):
-            thispackage = Package(dimensions, nosort=True)
+            thispackage = Package(dimensions, weight=todo[0].weight, nosort=True)
             if thispackage in bin:
                 counter = allpermutations_helper(permuted + [thispackage], others, maxcounter, callback,
                                                  bin, bestpack, counter)
@@ -176,21 +204,36 @@ def allpermutations_helper(permuted, todo, maxcounter, callback, bin, bestpack,
         return counter
 
 
+def lowerbound(bin, packages, maxweight=None):
+    """Returns the minimum number of bins needed for the packages which can be packed at all.
+
+    The bound is derived from the volume and, if maxweight is given, the weight of the packages."""
+    packable = [package for package in packages if package in bin
+                and (maxweight is None or (package.weight or 0) <= maxweight)]
+    if not packable:
+        return 0
+    bound = max(1, int(math.ceil(sum([package.volume for package in packable]) / float(bin.volume))))
+    if maxweight:
+        bound = max(bound, int(math.ceil(packageweight(packable) / float(maxweight))))
+    return bound
+
+
 def trypack(bin, packages, bestpack):
-    bins, rest = packit(bin, packages)
+    bins, rest = packit(bin, packages, bestpack['maxweight'])
     if len(bins) < bestpack['bincount']:
         bestpack['bincount'] = len(bins)
         bestpack['bins'] = bins
         bestpack['rest'] = rest
-    if bestpack['bincount'] < 2:
+    if bestpack['bincount'] <= bestpack['lowerbound']:
         raise Timeout('optimal solution found')
     return len(packages)
 
 
-def allpermutations(todo, bin, iterlimit=5000):
+def allpermutations(todo, bin, iterlimit=5000, maxweight=None):
     random.seed(1)
     random.shuffle(todo)
-    bestpack = dict(bincount=len(todo) + 1)
+    bestpack = dict(bincount=len(todo) + 1, maxweight=maxweight,
+                    lowerbound=max(1, lowerbound(bin, todo, maxweight)))
     try:
         # First try unpermuted
         trypack(bin, todo, bestpack)
@@ -201,14 +244,15 @@ def allpermutations(todo, bin, iterlimit=5000):
     return bestpack['bins'], bestpack['rest']
 
 
-def binpack(packages, bin=None, iterlimit=5000):
+def binpack(packages, bin=None, iterlimit=5000, maxweight=None):
     """Packs a list of Package() objects into a number of equal-sized bins.
 
     Returns a list of bins listing the packages within the bins and a list of packages which can't be
-    packed because they are to big."""
+    packed because they are to big. If maxweight is given, no bin gets heavier than maxweight and packages
+    heavier than maxweight are returned as unpackable as well."""
     if not bin:
         bin = Package("600x400x400")
-    return allpermutations(packages, bin, iterlimit)
+    return allpermutations(packages, bin, iterlimit, maxweight)
 
 
 def test():
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+benchmark.py - compare the speed of the DPD routing engines.
+
+Samples destinations from the shipped routing tables and measures each engine: cold start, warm
+per-lookup p50/p99, batch throughput and the memory allocated while starting up.
+
+    python -m pyshipping.carriers.dpd.benchmark -n 2000 -e routeindex,decisiontable
+
+Copyright 2026 HUDORA GmbH. Published under a BSD License.
+"""
+
+import optparse
+import random
+import tracemalloc
+from pyshipping.carriers.dpd import georoute
+from pyshipping.carriers.dpd.metrics import clock
+
+
+# engines take a Destination and return a Route, the process wide objects are created on first use
+ENGINES = {
+    'get_route_without_cache': lambda destination: georoute.get_route_without_cache(
+        destination.country, destination.postcode, destination.city, destination.service),
+    'routeindex': lambda destination: georoute.get_routeindex().route(destination),
+    'decisiontable': lambda destination: georoute.get_decisiontable().route(destination),
+}
+
+# share of the sampled postcodes matching a route exactly, by range or only the catch all route
+KINDS = (('exact', 4), ('range', 4), ('catchall', 2))
+SERVICES = (('101', 8), ('327', 1), ('136', 1))
+
+
+def _choose(rnd, weighted):
+    """Pick a value from a sequence of (value, weight) pairs."""
+    values, weights = zip(*weighted)
+    return rnd.choices(values, weights)[0]
+
+
+def sample_destinations(routedata, count, seed=None, weights=None):
+    """Return count (kind, Destination) pairs sampled from the routes table.
+
+    Countries are picked proportional to weights, a dict mapping countries to their share of the
+    parcels, which defaults to the number of routes per country. kind tells if the postcode was taken
+    from an exact route, from within a range route or made up to hit the catch all route of the country.
+    """
+    rnd = random.Random(seed)
+    cur = routedata.db.cursor()
+    cur.execute("SELECT DestinationCountry, BeginPostCode, EndPostCode FROM routes")
+    exact = {}
+    ranges = {}
+    lengths = {}
+    for country, begin, end in cur.fetchall():
+        if begin and end:
+            ranges.setdefault(country, []).append((begin, end))
+        elif begin:
+            exact.setdefault(country, []).append(begin)
+        if begin:
+            lengths.setdefault(country, set()).add(len(begin))
+    if weights is None:
+        weights = dict((country, len(exact.get(country, [])) + len(ranges.get(country, [])))
+                       for country in set(exact) | set(ranges))
+
+    destinations = []
+    countries = [item for item in sorted(weights.items()) if item[1] > 0]
+    while len(destinations) < count:
+        country = _choose(rnd, countries)
+        kind = _choose(rnd, KINDS)
+        if kind == 'exact' and exact.get(country):
+            postcode = rnd.choice(exact[country])
+        elif kind == 'range' and ranges.get(country):
+            begin, end = rnd.choice(ranges[country])
+            postcode = begin
+            if begin.isdigit() and end.isdigit() and len(begin) == len(end) and begin <= end:
+                postcode = str(rnd.randint(int(begin), int(end))).zfill(len(begin))
+        else:
+            kind = 'catchall'
+            length = rnd.choice(sorted(lengths.get(country, [4])))
+            postcode = ''.join([rnd.choice('0123456789') for _ in range(length)])
+        destinations.append((kind, georoute.Destination(country, postcode, None, _choose(rnd, SERVICES))))
+    return destinations
+
+
+def _percentile(ordered, percent):
+    """Return the value at percent of the sorted list ordered."""
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100.0))]
+
+
+def run_engine(engine, destinations, cold=True):
+    """Benchmark engine on destinations, a list of Destination objects.
+
+    If cold is True, the process wide routing objects are dropped to measure the first lookup and the
+    memory allocated by it. Returns a dict with the results, times in seconds."""
+    result = dict(samples=len(destinations))
+    if cold:
+        georoute.reload()
+        start = clock()
+        _lookup(engine, destinations[0])
+        result['cold_start'] = clock() - start
+        georoute.reload()
+        tracemalloc.start()
+        _lookup(engine, destinations[0])
+        result['memory'] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+    _lookup(engine, destinations[0])
+    timings = []
+    errors = 0
+    for destination in destinations:
+        start = clock()
+        if _lookup(engine, destination) is None:
+            errors += 1
+        timings.append(clock() - start)
+    timings.sort()
+    result.update(p50=_percentile(timings, 50), p99=_percentile(timings, 99), errors=errors)
+
+    start = clock()
+    for destination in destinations:
+        _lookup(engine, destination)
+    result['throughput'] = len(destinations) / (clock() - start)
+    return result
+
+
+def _lookup(engine, destination):
+    """Route destination, returns None instead of raising routing errors."""
+    try:
+        return engine(destination)
+    except georoute.GeorouteException:
+        return None
+
+
+def run(engines=None, count=1000, seed=0, cold=True, limits=None):
+    """Benchmark the engines named in engines on the same sample of count destinations.
+
+    limits maps engine names to a smaller number of destinations to use. Returns a dict with the
+    results of run_engine() per engine name."""
+    if engines is None:
+        engines = sorted(ENGINES)
+    destinations = [destination for kind, destination
+                    in sample_destinations(georoute.get_routedata(), count, seed)]
+    limits = limits or {}
+    return dict((name, run_engine(ENGINES[name], destinations[:limits.get(name, count)], cold))
+                for name in engines)
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-n', '--samples', type='int', default=1000, help="number of destinations")
+    parser.add_option('-e', '--engines', default=','.join(sorted(ENGINES)), help="comma separated engines")
+    parser.add_option('-s', '--seed', type='int', default=0, help="seed for sampling destinations")
+    parser.add_option('--slow-samples', type='int', default=100,
+                      help="number of destinations for get_route_without_cache")
+    options, args = parser.parse_args()
+    results = run(options.engines.split(','), options.samples, options.seed,
+                  limits={'get_route_without_cache': options.slow_samples})
+    print("%-24s %7s %10s %10s %10s %12s %10s" % ('engine', 'samples', 'cold [s]', 'p50 [us]', 'p99 [us]',
+                                                  'lookups/s', 'memory [MB]'))
+    for name, result in sorted(results.items()):
+        print("%-24s %7d %10.2f %10.1f %10.1f %12.0f %10.1f" % (
+            name, result['samples'], result['cold_start'], result['p50'] * 1000000, result['p99'] * 1000000,
+            result['throughput'], result['memory'] / 1024.0 / 1024))
+
+
+if __name__ == '__main__':
+    main()
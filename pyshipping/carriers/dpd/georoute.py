@@ -9,13 +9,40 @@ Copyright 2006, 2007 HUDORA GmbH. Published under a BSD License.
 
 import os
 import os.path
+import bisect
+import collections
+import fcntl
+import gc
+import glob
 import gzip
+import itertools
 import logging
+import mmap
+import shutil
 import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
+import urllib.request
+import zlib
+from array import array
+from pyshipping.carriers.dpd.metrics import metrics, clock
 
 
 ROUTETABLES_BASE = os.path.join(os.path.split(os.path.abspath(__file__))[0], 'georoutetables')
 ROUTES_DB_BASE = '/tmp/dpdroutes'
+# number of ROUTES lines inserted per executemany() call when building the database
+BUILD_BATCHSIZE = 20000
+# bytes read and decompressed at once by _readfile_batches()
+READ_BLOCKSIZE = 1 << 16
+# idle connections to the routing database kept per RouteData object
+CONNECTION_POOLSIZE = 4
+# page cache in KiB and memory mapped bytes of each connection to the built routing database
+SERVING_CACHE_KIB = 16384
+SERVING_MMAP_SIZE = 256 * 1024 * 1024
 
 
 # Quelle: http://de.wikipedia.org/wiki/Liste_der_Kfz-Nationalitätszeichen
@@ -90,9 +117,13 @@ class Destination(object):
         self.postcode = postcode
 
 
-class Route:
+class Route(object):
     """Output of the routing algorithm."""
 
+    __slots__ = ('d_depot', 'o_sort', 'd_sort', 'grouping_priority', 'barcode_id', 'iata_code',
+                 'service_text', 'service_mark', 'country', 'serviceinfo', 'countrynum',
+                 'routingtable_version', 'postcode')
+
     def __init__(self, d_depot, o_sort, d_sort, grouping_priority, barcode_id,
                  iata_code, service_text, service_mark, country, serviceinfo, countrynum,
                  routingtable_version, postcode):
@@ -131,6 +162,18 @@ Service Text: %s""" % (self.country, self.d_depot, self.o_sort, self.d_sort,
 
         return output
 
+    @property
+    def __dict__(self):
+        """The attributes as a dict, so vars(route) keeps working."""
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __getstate__(self):
+        return tuple([getattr(self, name) for name in self.__slots__])
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
     def __repr__(self):
         return repr(vars(self))
 
@@ -155,56 +198,427 @@ def _readfile(filename):
         yield line.split('|')
 
 
+def _readblocks(filename):
+    """Yield the text of filename in blocks of about READ_BLOCKSIZE characters, decoded as latin1.
+
+    The .gz file is preferred and decompressed with zlib directly, concatenated gzip members are
+    supported. Plain files are opened in text mode, so line endings are translated like in _readfile().
+    """
+    if not os.path.exists(filename + '.gz'):
+        with open(filename, 'r', encoding='latin1') as fhandle:
+            for block in iter(lambda: fhandle.read(READ_BLOCKSIZE), ''):
+                yield block
+        return
+    with open(filename + '.gz', 'rb') as fhandle:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        for data in iter(lambda: fhandle.read(READ_BLOCKSIZE), b''):
+            while data:
+                block = decompressor.decompress(data)
+                if block:
+                    yield block.decode('latin1')
+                data = b''
+                if decompressor.eof:
+                    data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        block = decompressor.flush()
+        if block:
+            yield block.decode('latin1')
+
+
+def _split_lines(lines):
+    """Return the fields of lines, skipping comments, like _readfile() does for each line."""
+    # the lists of fields can't form reference cycles, collecting garbage while creating hundreds of
+    # thousands of them would only cost time
+    collect = gc.isenabled()
+    gc.disable()
+    try:
+        lines = [line.strip() for line in lines]
+        return [line.split('|') for line in lines if line[:1] != '#']
+    finally:
+        if collect:
+            gc.enable()
+
+
+def _readfile_batches(filename, batchsize=BUILD_BATCHSIZE):
+    """Read file like _readfile() but yield lists of up to batchsize lines.
+
+    The file is decompressed and decoded in blocks, which are split into lines and fields with list
+    comprehensions while the garbage collector is paused. This saves the per line overhead of a
+    GzipFile, most of the remaining time is spent creating the field strings."""
+    batch = []
+    rest = ''
+    for block in _readblocks(filename):
+        lines = (rest + block).split('\n')
+        # the last line may continue in the next block
+        rest = lines.pop()
+        batch.extend(_split_lines(lines))
+        while len(batch) >= batchsize:
+            yield batch[:batchsize]
+            del batch[:batchsize]
+    # like file iteration, a last line without newline is still a line
+    if rest:
+        batch.extend(_split_lines([rest]))
+    if batch:
+        yield batch
+
+
+def read_version(path=ROUTETABLES_BASE):
+    """Return the version of the routing tables found in path."""
+    for line in open(os.path.join(path, 'SERVICE')):
+        if line.startswith('#Version: '):
+            return line.split(':')[1].strip()
+    raise InvalidFormatError("There's no version in the SERVICE file")
+
+
+def normalize_location(name):
+    """Return name case folded, without accents and with single spaces, for comparing city names.
+
+    >>> normalize_location(u' K\u00f6ln  am   Rhein')
+    'koln am rhein'
+    """
+    decomposed = unicodedata.normalize('NFKD', name)
+    stripped = ''.join([char for char in decomposed if not unicodedata.combining(char)])
+    return ' '.join(stripped.casefold().split())
+
+
+class LocationIndex(object):
+    """In-memory index of all LOCATION.* files for translating city names to postcodes.
+
+    City names are compared normalized, see normalize_location(). If a city is listed several times
+    for a country, the first entry wins, reading LOCATION.DE first. `keys` is sorted for prefix searches.
+    """
+
+    def __init__(self, path):
+        filenames = set()
+        for filename in os.listdir(path):
+            if filename.startswith('LOCATION.'):
+                # _readfile() opens the .gz file itself
+                filenames.add(filename[:-3] if filename.endswith('.gz') else filename)
+        self.postcodes = {}
+        entries = set()
+        for filename in sorted(filenames, key=lambda filename: (filename != 'LOCATION.DE', filename)):
+            for line in _readfile(os.path.join(path, filename)):
+                city, country, postcode = line[1:4]
+                key = normalize_location(city)
+                self.postcodes.setdefault((key, country.upper()), postcode)
+                entries.add((key, country.upper(), city, postcode))
+        self.entries = sorted(entries)
+        self.keys = [entry[0] for entry in self.entries]
+
+    def translate(self, city, country):
+        """Return postcode for given city and country."""
+        postcode = self.postcodes.get((normalize_location(city or ''), (country or '').upper()))
+        if postcode is None:
+            raise TranslationError("Cannot find postcode for location %s, %s" % (city, country))
+        return postcode
+
+    def translate_many(self, locations):
+        """Translate a list of (city, country) pairs.
+
+        Returns a list with the postcode or the TranslationError for each pair."""
+        ret = []
+        for city, country in locations:
+            try:
+                ret.append(self.translate(city, country))
+            except TranslationError as exception:
+                ret.append(exception)
+        return ret
+
+    def search(self, prefix, country=None):
+        """Return (city, country, postcode) for all cities starting with prefix, sorted by city."""
+        prefix = normalize_location(prefix)
+        found = []
+        for entry in self.entries[bisect.bisect_left(self.keys, prefix):]:
+            if not entry[0].startswith(prefix):
+                break
+            if country is None or entry[1] == country.upper():
+                found.append((entry[2], entry[1], entry[3]))
+        return found
+
+
+# tables a complete routing database has
+DATABASE_TABLES = frozenset(['depots', 'location', 'routes', 'routeplaces', 'route_services', 'tablefiles'])
+# table files RouteData reads into memory, copies are stored in the tablefiles table of the database
+MEMORY_TABLEFILES = ('COUNTRY', 'DEPOTS', 'SERVICE', 'SERVICEINFO.DE')
+
+
+def _database_complete(filename):
+    """Return True if the routing database filename exists and has all DATABASE_TABLES."""
+    if not os.path.exists(filename):
+        return False
+    db = sqlite3.connect(filename)
+    try:
+        tables = set(row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+    except sqlite3.DatabaseError:
+        return False
+    finally:
+        db.close()
+    return DATABASE_TABLES <= tables
+
+
+def _previous_database(version):
+    """Return (version, filename) of the newest complete routing database of another version.
+
+    Returns None if there is none."""
+    prefix = ROUTES_DB_BASE + '-'
+    found = []
+    for filename in glob.glob(glob.escape(prefix) + '*.db'):
+        other = filename[len(prefix):-len('.db')]
+        if other != version and _database_complete(filename):
+            found.append((os.path.getmtime(filename), other, filename))
+    if not found:
+        return None
+    return max(found)[1:]
+
+
+class _Checkout(object):
+    """A connection used by one thread, handed back to the pool when the thread ends."""
+
+    __slots__ = ('pool', 'db')
+
+    def __init__(self, pool, db):
+        self.pool = pool
+        self.db = db
+
+    def __del__(self):
+        self.pool.release(self.db)
+
+
+class ConnectionPool(object):
+    """Hands out one sqlite connection per thread.
+
+    connect is called to open a new connection. A thread keeps its connection until it ends, then the
+    connection is kept for the next thread. At most size idle connections are kept, the others are
+    closed.
+    """
+
+    def __init__(self, connect, size=CONNECTION_POOLSIZE):
+        self.connect = connect
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = []
+        self.closed = False
+        self.local = threading.local()
+
+    def get(self):
+        """Return the connection of the calling thread."""
+        checkout = getattr(self.local, 'checkout', None)
+        if checkout is None:
+            with self.lock:
+                db = self.idle.pop() if self.idle else None
+            if db is None:
+                db = self.connect()
+            checkout = self.local.checkout = _Checkout(self, db)
+        return checkout.db
+
+    def release(self, db):
+        """Take back the connection of a thread."""
+        with self.lock:
+            if not self.closed and len(self.idle) < self.size:
+                self.idle.append(db)
+                return
+        db.close()
+
+    def close(self):
+        """Close the idle connections and the one of the calling thread.
+
+        Connections still used by other threads are closed when those threads end."""
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for db in idle:
+            db.close()
+        self.local = threading.local()
+
+
 class RouteData(object):
-    """More convenient representation of the georoute data."""
+    """More convenient representation of the georoute data.
+
+    After it is built the routing database is never written, `db` is a read-only connection for the
+    calling thread, see serving_connection()."""
+
+    def __init__(self, routingdepot='0142', progress=None, wait=True):
+        """Routingdepot the depot from where you are sending.
 
-    def __init__(self, routingdepot='0142'):
-        """Routingdepot the depot from where you are sending."""
+        If the routing database has to be built, progress is called as progress(table, rows) while
+        loading the tables. Only one process builds the database, the others wait for it. With wait=False
+        they use the database of a previous version instead, if there is one, see open_database()."""
+        start = clock()
         self.routingdepot = routingdepot
         self.routingdepotgroups = ''
         self.routingdepotcountry = ''
 
-        services = os.path.join(ROUTETABLES_BASE, 'SERVICE')
-        self.version = None
-        for line in open(services):
-            if line.startswith('#Version: '):
-                self.version = line.split(':')[1].strip()
-                break
-        if self.version is None:
-            raise InvalidFormatError("There's no version in the SERVICE file")
-
+        self.version = installed = read_version(ROUTETABLES_BASE)
+        self.buildtime = None
+        # the database is the same for all routing depots, the depot specific part is the routedepots view
+        self.filename = self.open_database(ROUTES_DB_BASE + ('-%s.db' % self.version), progress, wait)
+        if self.version == installed:
+            self.load_tables(ROUTETABLES_BASE)
+        else:
+            self.load_stored_tables()
+        # RouteData objects are shared between threads, see RouteDataRegistry
+        self.connections = ConnectionPool(self.serving_connection)
+        if metrics.enabled:
+            metrics.lap('routedata.startup', start)
+
+    def load_tables(self, path):
+        """Read countries, depots, services, service texts and locations from the table files in path."""
         self.countries = {}
-        for line in _readfile(os.path.join(ROUTETABLES_BASE, 'COUNTRY')):
+        for line in _readfile(os.path.join(path, 'COUNTRY')):
             isonum, isoname = line[:2]
             self.countries[isoname.upper()] = isonum
 
         self.depots = {}
-        for line in _readfile(os.path.join(ROUTETABLES_BASE, 'DEPOTS')):
+        for line in _readfile(os.path.join(path, 'DEPOTS')):
             geopostdepotnumber = line[0]
             self.depots[geopostdepotnumber] = tuple(line)
+        if self.routingdepot in self.depots:
+            self.routingdepotgroups = self.depots[self.routingdepot][2]
+            self.routingdepotgrouplist = self.routingdepotgroups.split(',')
+            self.routingdepotcountry = self.depots[self.routingdepot][9]
 
         self.services = {}
-        for line in _readfile(os.path.join(ROUTETABLES_BASE, 'SERVICE')):
+        for line in _readfile(os.path.join(path, 'SERVICE')):
             servicecode = line[0]
             self.services[servicecode] = tuple(line)
 
         self.serviceinfo = {}
-        for line in _readfile(os.path.join(ROUTETABLES_BASE, 'SERVICEINFO.DE')):
+        for line in _readfile(os.path.join(path, 'SERVICEINFO.DE')):
             servicecode = line[0]
             self.serviceinfo[servicecode] = line[1]
 
-        filename = ROUTES_DB_BASE + ('-%s-%s.db' % (routingdepot, self.version))
-        self.db = sqlite3.connect(filename)
+        self.locations = LocationIndex(path)
+
+    def load_stored_tables(self):
+        """Read the in-memory tables from the copies of the table files stored in the database.
+
+        Used for a database of a previous version, so all data belongs to the same version."""
+        tempdir = tempfile.mkdtemp()
+        try:
+            db = sqlite3.connect(self.filename)
+            try:
+                for name, content in db.execute("SELECT name, content FROM tablefiles"):
+                    with open(os.path.join(tempdir, name), 'wb') as tablefile:
+                        tablefile.write(content)
+            finally:
+                db.close()
+            self.load_tables(tempdir)
+        finally:
+            shutil.rmtree(tempdir)
+
+    def open_database(self, filename, progress=None, wait=True):
+        """Return the name of the routing database to use, building it if it is missing or incomplete.
+
+        Processes building the same version take turns on an exclusive lock on filename + '.lock'. The
+        one holding it builds into a temporary file and renames it to filename, so readers only ever see a
+        complete database. A process getting the lock after the build finds it complete and does nothing.
+        If wait is False and the lock is taken, the newest complete database of a previous version is used
+        and `version` set to it, the in-memory tables are then read from that database too, see
+        load_stored_tables(). Without such a database the process waits anyway."""
+        if _database_complete(filename):
+            return filename
+        with open(filename + '.lock', 'a') as lockfile:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                previous = None if wait else _previous_database(self.version)
+                if previous is not None:
+                    logging.info("routing database %s is being built, using version %s",
+                                 self.version, previous[0])
+                    self.version = previous[0]
+                    return previous[1]
+                logging.info("waiting for routing database %s to be built", self.version)
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                if not _database_complete(filename):
+                    self.build_file(filename, progress)
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+        return filename
+
+    def build_file(self, filename, progress=None):
+        """Build and validate the routing database in a temporary file and rename it to filename.
+
+        A database failing validate() is removed, so a broken build is never used."""
+        tmpname = '%s.%d.tmp' % (filename, os.getpid())
         # disable the default behavior of wrapping everything in a transaction
-        self.db.isolation_level = None
-
-        self.read_depots(ROUTETABLES_BASE)
-        self.read_locations(ROUTETABLES_BASE)
-        self.read_routes(ROUTETABLES_BASE)
+        self.connections = ConnectionPool(lambda: sqlite3.connect(tmpname, isolation_level=None))
+        try:
+            self.buildtime = self.build_database(ROUTETABLES_BASE, progress)
+            self.validate()
+        except:
+            self.connections.close()
+            os.remove(tmpname)
+            raise
+        self.connections.close()
+        os.rename(tmpname, filename)
+
+    def serving_connection(self):
+        """Open a read-only connection to the built routing database and create its routedepots view.
+
+        The database is opened as immutable, so sqlite neither locks it nor checks it for changes. This is
+        safe because a new database is always renamed into place, see build_file()."""
+        db = sqlite3.connect('file:%s?mode=ro&immutable=1' % urllib.request.pathname2url(self.filename),
+                             uri=True, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA cache_size=%d" % -SERVING_CACHE_KIB)
+        db.execute("PRAGMA mmap_size=%d" % SERVING_MMAP_SIZE)
+        self.create_routedepots_view(db)
+        return db
+
+    @property
+    def db(self):
+        """The connection to the routing database of the calling thread."""
+        return self.connections.get()
+
+    def build_database(self, path, progress=None):
+        """Create all missing tables of the routing database in a single transaction.
+
+        Returns the time spent in seconds or None if the database was already complete."""
+        start = time.time()
+        c = self.db.cursor()
+        c.execute("PRAGMA synchronous=OFF")
+        c.execute("PRAGMA temp_store=MEMORY")
+        c.execute("BEGIN")
+        try:
+            built = []
+            for table, read, args in (('depots', self.read_depots, (path, progress)),
+                                      ('location', self.read_locations, (path, progress)),
+                                      ('routes', self.read_routes, (path, progress)),
+                                      ('route_services', self.read_route_services, (progress, )),
+                                      ('tablefiles', self.read_tablefiles, (path, ))):
+                tablestart = clock()
+                built.append(read(*args))
+                if built[-1] and metrics.enabled:
+                    metrics.lap('build.' + table, tablestart)
+        except:
+            c.execute("ROLLBACK")
+            raise
+        c.execute("COMMIT")
+        if not any(built):
+            return None
+        buildtime = time.time() - start
+        if metrics.enabled:
+            metrics.record('build.database', buildtime)
+        logging.info("built routing database version %s in %.1fs", self.version, buildtime)
+        return buildtime
+
+    def validate(self):
+        """Check that the routing database is complete and consistent.
+
+        Raises InvalidFormatError otherwise."""
+        c = self.db.cursor()
+        for table in ('depots', 'routes', 'routeplaces', 'route_services'):
+            c.execute("SELECT COUNT(*) FROM %s" % table)
+            if not c.fetchone()[0]:
+                raise InvalidFormatError("Table %s of routing database %s is empty" % (table, self.version))
+        c.execute("PRAGMA quick_check")
+        result = c.fetchone()[0]
+        if result != 'ok':
+            raise InvalidFormatError("Routing database %s is damaged: %s" % (self.version, result))
 
-    def read_depots(self, path):
+    def read_depots(self, path, progress=None):
         """Read DEPOTS file and save all the information in a
-        SQLite database."""
+        SQLite database. Returns True if the table had to be created."""
         c = self.db.cursor()
 
         c.execute("""SELECT COUNT(*)
@@ -228,18 +642,17 @@ class RouteData(object):
              Mail TEXT,
              Web TEXT)""")
 
-            for line in _readfile(os.path.join(path, 'DEPOTS')):
-                c.execute("""INSERT INTO depots
+            c.executemany("""INSERT INTO depots
                              VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                          line[:14])
-                if line[0] == self.routingdepot:
-                    self.routingdepotgroups = line[2]
-                    self.routingdepotgrouplist = line[2].split(',')
-                    self.routingdepotcountry = line[9]
-            c.execute('VACUUM;')
-
-    def read_locations(self, path):
-        """Read LOCATION file and save all the information in a SQLite database."""
+                          (line[:14] for line in _readfile(os.path.join(path, 'DEPOTS'))))
+            if progress:
+                progress('depots', c.rowcount)
+            return True
+        return False
+
+    def read_locations(self, path, progress=None):
+        """Read LOCATION file and save all the information in a SQLite database.
+        Returns True if the table had to be created."""
         c = self.db.cursor()
 
         c.execute("""SELECT COUNT(*)
@@ -253,14 +666,18 @@ class RouteData(object):
              Country TEXT,
              Postcode TEXT)""")
 
-            for line in _readfile(os.path.join(path, 'LOCATION.DE')):
-                c.execute('INSERT INTO location VALUES (?,?,?,?)',
-                          line[:4])
-            c.execute('VACUUM;')
+            c.executemany('INSERT INTO location VALUES (?,?,?,?)',
+                          (line[:4] for line in _readfile(os.path.join(path, 'LOCATION.DE'))))
+            if progress:
+                progress('location', c.rowcount)
+            return True
+        return False
+
+    def read_routes(self, path, progress=None):
+        """Read ROUTES file and save all the information in a SQLite database.
 
-    def read_routes(self, path):
-        """Read ROUTES file and save all the information in a SQLite database."""
-        # self.db = sqlite3.connect(ROUTES_DB)
+        The file is parsed in blocks and inserted in batches of BUILD_BATCHSIZE lines, the indexes are
+        created after all rows are loaded. Returns True if the table had to be created."""
         c = self.db.cursor()
 
         c.execute("""SELECT COUNT(*)
@@ -284,29 +701,89 @@ class RouteData(object):
 
             c.execute("""SELECT COUNT(*)
                          FROM sqlite_master
-                         WHERE type='table' AND name='routedepots'""")
+                         WHERE type='table' AND name='routeplaces'""")
             if not c.fetchone()[0]:
-                logging.info("regenerating routedepots table")
-                c.execute("""CREATE TABLE routedepots
+                logging.info("regenerating routeplaces table")
+                c.execute("""CREATE TABLE routeplaces
                 (route INTEGER,
-                 depot TEXT)""")
-
-            c.execute("PRAGMA synchronous=OFF;")
-            c.execute("PRAGMA temp_store=MEMORY;")
-            i = 1
-            for line in _readfile(os.path.join(path, 'ROUTES')):
-                services = self.expand_services(line[3])
-                c.execute('INSERT INTO routes VALUES (?,?,?,?,?,?,?,?,?,?,?,?)',
-                          [i] + line[:3] + [services] + line[4:-1])
-                self.expand_depots(i, line[4], c)
-                i += 1
+                 kind TEXT,
+                 first TEXT,
+                 last TEXT)""")
+
+            # the same ServiceCodes and RoutingPlaces values occur over and over again
+            expanded_services = {}
+            expanded_places = {}
+            route = 0
+            for batch in _readfile_batches(os.path.join(path, 'ROUTES'), BUILD_BATCHSIZE):
+                routes = []
+                places = []
+                for line in batch:
+                    route += 1
+                    if line[3] not in expanded_services:
+                        expanded_services[line[3]] = self.expand_services(line[3])
+                    routes.append([route] + line[:3] + [expanded_services[line[3]]] + line[4:-1])
+                    if line[4] not in expanded_places:
+                        expanded_places[line[4]] = self.parse_routingplaces(line[4])
+                    places.extend([(route, ) + place for place in expanded_places[line[4]]])
+                c.executemany('INSERT INTO routes VALUES (?,?,?,?,?,?,?,?,?,?,?,?)', routes)
+                c.executemany("INSERT INTO routeplaces(route, kind, first, last) VALUES (?, ?, ?, ?)", places)
+                logging.debug("loaded %d routes", route)
+                if progress:
+                    progress('routes', route)
 
             c.execute("CREATE INDEX routes_DestinationCountry ON routes(DestinationCountry)")
             c.execute("CREATE INDEX routes_BeginPostCode ON routes(BeginPostCode)")
             c.execute("CREATE INDEX routes_EndPostCode ON routes(EndPostCode)")
-            c.execute("CREATE INDEX routedepots_route ON routedepots(route)")
-            c.execute("CREATE INDEX routedepots_depot ON routedepots(depot)")
-            c.execute('VACUUM;')  # also commits the database
+            c.execute("CREATE INDEX routeplaces_route ON routeplaces(route)")
+            return True
+        return False
+
+    def read_route_services(self, progress=None):
+        """Generate the route_services table listing every service of a route in its own row.
+
+        This allows selecting routes by service using an index instead of a LIKE scan of the comma
+        separated ServiceCodes column. Returns True if the table had to be created."""
+        c = self.db.cursor()
+
+        c.execute("""SELECT COUNT(*)
+                     FROM sqlite_master
+                     WHERE type='table' AND name='route_services'""")
+        if not c.fetchone()[0]:
+            logging.info("regenerating route_services table")
+            c.execute("""CREATE TABLE route_services
+            (route INTEGER,
+             service TEXT)""")
+            c.execute("SELECT id, ServiceCodes FROM routes WHERE ServiceCodes != ''")
+            rows = c.fetchall()
+            c.executemany("INSERT INTO route_services(route, service) VALUES (?, ?)",
+                          ((route, service) for route, services in rows for service in services.split(',')))
+            if progress:
+                progress('route_services', c.rowcount)
+            # covering index for Router.select_service()
+            c.execute("CREATE INDEX route_services_service ON route_services(service, route)")
+            return True
+        return False
+
+    def read_tablefiles(self, path):
+        """Store copies of the MEMORY_TABLEFILES and LOCATION.* files in the tablefiles table.
+
+        Returns True if the table had to be created."""
+        c = self.db.cursor()
+
+        c.execute("""SELECT COUNT(*)
+                     FROM sqlite_master
+                     WHERE type='table' AND name='tablefiles'""")
+        if not c.fetchone()[0]:
+            c.execute("""CREATE TABLE tablefiles
+            (name TEXT PRIMARY KEY,
+             content BLOB)""")
+            for name in os.listdir(path):
+                basename = name[:-3] if name.endswith('.gz') else name
+                if basename in MEMORY_TABLEFILES or basename.startswith('LOCATION.'):
+                    with open(os.path.join(path, name), 'rb') as tablefile:
+                        c.execute("INSERT INTO tablefiles VALUES (?, ?)", (name, tablefile.read()))
+            return True
+        return False
 
     def expand_services(self, services):
         """Expand services list."""
@@ -322,37 +799,56 @@ class RouteData(object):
 
         return ','.join(services_list)
 
-    def expand_depots(self, route, depots, c):
-        """Parse depots list and generate route->depots relationship."""
-        # but only four "our" depot.
-        # if you change the self.routingdepot, you have to rebuild the database
-        if depots == '':
-            c.execute("""INSERT INTO routedepots(route, depot) VALUES (?, ?)""", (route, depots))
-            return
-
-        for depot in depots.split(','):
-            if depot.startswith('C'):
-                if depot[1:] == self.routingdepotcountry:
-                    c.execute("""INSERT INTO routedepots(route, depot) VALUES(?, ?)""", (route,
-                                                                                         self.routingdepot))
-            elif depot.startswith('D'):
-                if len(depot) > 5:
-                    start = int(depot[1:5])
-                    end = int(depot[5:])
-                    for i in range(start, end + 1):
-                        if ("%04d" % i) == self.routingdepot:
-                            c.execute("""INSERT INTO routedepots(route, depot) VALUES(?, ?)""",
-                                      (route, self.routingdepot))
+    def expand_routingplaces(self, route, places):
+        """Parse the RoutingPlaces of a route into (route, kind, first, last) rows for all depots.
+
+        kind is '' for routes valid for every depot, 'C' for a depot country, 'D' for a range of depot
+        numbers and 'G' for a depot group. Which of the rows apply to a routing depot is decided by the
+        routedepots view, see create_routedepots_view()."""
+        return [(route, ) + place for place in self.parse_routingplaces(places)]
+
+    def parse_routingplaces(self, places):
+        """Parse a RoutingPlaces value into (kind, first, last) tuples, see expand_routingplaces()."""
+        if places == '':
+            return [('', '', '')]
+
+        ret = []
+        for place in places.split(','):
+            if place.startswith('C'):
+                ret.append(('C', place[1:], place[1:]))
+            elif place.startswith('D'):
+                if len(place) > 5:
+                    ret.append(('D', "%04d" % int(place[1:5]), "%04d" % int(place[5:])))
                 else:
-                    if depot[1:5] == self.routingdepot:
-                        c.execute("""INSERT INTO routedepots(route, depot) VALUES(?, ?)""",
-                                  (route, depot[1:5]))
-            elif depot.startswith('G'):
-                if depot[1:] in self.routingdepotgroups:
-                    c.execute("INSERT INTO routedepots(route, depot) VALUES(?, ?)",
-                              (route, self.routingdepot))
+                    ret.append(('D', place[1:5], place[1:5]))
+            elif place.startswith('G'):
+                ret.append(('G', place[1:], place[1:]))
             else:
-                raise InvalidFormatError("Unable to parse depot '%s'" % depot)
+                raise InvalidFormatError("Unable to parse depot '%s'" % place)
+        return ret
+
+    def create_routedepots_view(self, db):
+        """Create the routedepots view listing the routes usable from self.routingdepot.
+
+        The view is temporary and only exists for the connection db, so every RouteData object sees the
+        routes of its own routing depot in the shared database. Routes valid for every depot are listed
+        with an empty depot."""
+        def quote(value):
+            return "'%s'" % value.replace("'", "''")
+
+        conditions = ["kind = ''",
+                      "(kind = 'C' AND first = %s)" % quote(self.routingdepotcountry),
+                      "(kind = 'G' AND instr(%s, first) > 0)" % quote(self.routingdepotgroups)]
+        if len(self.routingdepot) == 4 and self.routingdepot.isdigit():
+            # only then comparing strings is the same as comparing depot numbers
+            conditions.append("(kind = 'D' AND first <= %s AND last >= %s)"
+                              % (quote(self.routingdepot), quote(self.routingdepot)))
+        c = db.cursor()
+        c.execute("DROP VIEW IF EXISTS temp.routedepots")
+        c.execute("""CREATE TEMP VIEW routedepots AS
+                     SELECT route, CASE kind WHEN '' THEN '' ELSE %s END AS depot
+                     FROM routeplaces
+                     WHERE %s""" % (quote(self.routingdepot), ' OR '.join(conditions)))
 
     def get_countrynum(self, isoname):
         """Return country ISO code."""
@@ -379,235 +875,1040 @@ class RouteData(object):
         return self.serviceinfo[servicecode]
 
     def translate_location(self, city, country):
-        """Return postcode for given city and country."""
-        cur = self.db.cursor()
-        cur.execute("SELECT Postcode FROM location WHERE City=? AND Country=?", (city, country))
-        rows = cur.fetchall()
-        if not rows:
-            raise TranslationError("Cannot find postcode for location %s, %s" % (city, country))
-        return rows[0][0]
+        """Return postcode for given city and country, see LocationIndex."""
+        return self.locations.translate(city, country)
+
+    def translate_locations(self, locations):
+        """Translate a list of (city, country) pairs, see LocationIndex.translate_many()."""
+        return self.locations.translate_many(locations)
+
+
+class RouteDataRegistry(object):
+    """Process wide registry of RouteData objects keyed by routing depot and table version.
+
+    Building a RouteData object reads all the table files and checks the database, so this is done only
+    once per routing depot. Use reload() after the routing tables have been updated. With
+    reload(background=True) the new version is built and validated in a background thread while the
+    old version keeps serving lookups, then `version` is switched over in one step.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.routedata = {}
+        self.routeindexes = {}
+        self.decisiontables = {}
+
+    def current_version(self):
+        """Return the table version in use, reading it on first use."""
+        if self.version is None:
+            with self.lock:
+                if self.version is None:
+                    self.version = read_version(ROUTETABLES_BASE)
+        return self.version
+
+    def get(self, routingdepot='0142'):
+        """Return the RouteData for routingdepot, creating it on first use."""
+        routedata = self.routedata.get((routingdepot, self.version))
+        if routedata is not None:
+            return routedata
+        with self.lock:
+            if self.version is None:
+                self.version = read_version(ROUTETABLES_BASE)
+            key = (routingdepot, self.version)
+            if key not in self.routedata:
+                self.routedata[key] = RouteData(routingdepot)
+            return self.routedata[key]
+
+    def get_index(self, routingdepot='0142'):
+        """Return the RouteIndex for routingdepot, creating it on first use."""
+        routeindex = self.routeindexes.get((routingdepot, self.version))
+        if routeindex is not None:
+            return routeindex
+        routedata = self.get(routingdepot)
+        with self.lock:
+            key = (routingdepot, routedata.version)
+            if key not in self.routeindexes:
+                self.routeindexes[key] = RouteIndex(routedata)
+            return self.routeindexes[key]
+
+    def get_decisiontable(self, routingdepot='0142'):
+        """Return the DecisionTable for routingdepot, loading or compiling it on first use."""
+        decisiontable = self.decisiontables.get((routingdepot, self.version))
+        if decisiontable is not None:
+            return decisiontable
+        routedata = self.get(routingdepot)
+        with self.lock:
+            key = (routingdepot, routedata.version)
+            if key not in self.decisiontables:
+                self.decisiontables[key] = DecisionTable(routedata)
+            return self.decisiontables[key]
+
+    def reload(self, background=False):
+        """Forget all RouteData, RouteIndex and DecisionTable objects and re-read the table version.
+
+        The objects are recreated lazily on their next use. If background is True, the objects for the
+        new version are prepared in a thread instead, see prepare(). The thread is returned."""
+        if background:
+            thread = threading.Thread(target=self.prepare, name='georoute-reload')
+            thread.daemon = True
+            thread.start()
+            return thread
+        with self.lock:
+            self.version = read_version(ROUTETABLES_BASE)
+            self.routedata = {}
+            self.routeindexes = {}
+            self.decisiontables = {}
+
+    def prepare(self):
+        """Build and validate the RouteData, RouteIndex and DecisionTable objects for the installed version.
+
+        All routing depots currently in use get new objects. Lookups keep using the old version until
+        everything is ready, then the registry switches to the new version. If building or validating
+        fails, the error is logged and the old version stays in use. Returns True if the registry
+        switched to a new version."""
+        try:
+            version = read_version(ROUTETABLES_BASE)
+            if version == self.version:
+                return False
+            with self.lock:
+                depots = set([depot for depot, oldversion in self.routedata]) or set(['0142'])
+                indexdepots = set([depot for depot, oldversion in self.routeindexes])
+                tabledepots = set([depot for depot, oldversion in self.decisiontables])
+            start = time.time()
+            routedata = {}
+            routeindexes = {}
+            decisiontables = {}
+            for depot in depots:
+                data = RouteData(depot)
+                data.validate()
+                routedata[(depot, data.version)] = data
+            for depot in indexdepots:
+                routeindexes[(depot, version)] = RouteIndex(routedata[(depot, version)])
+            for depot in tabledepots:
+                decisiontables[(depot, version)] = DecisionTable(routedata[(depot, version)],
+                                                                 routeindexes.get((depot, version)))
+        except Exception:
+            logging.exception("preparing routing data failed, keeping version %s", self.version)
+            return False
+        with self.lock:
+            self.routedata = routedata
+            self.routeindexes = routeindexes
+            self.decisiontables = decisiontables
+            self.version = version
+        logging.info("switched to routing data version %s after %.1fs", version, time.time() - start)
+        return True
+
+
+routedata_registry = RouteDataRegistry()
+
+
+def get_routedata(routingdepot='0142'):
+    """Return the process wide RouteData for routingdepot."""
+    return routedata_registry.get(routingdepot)
+
+
+def get_routeindex(routingdepot='0142'):
+    """Return the process wide RouteIndex for routingdepot."""
+    return routedata_registry.get_index(routingdepot)
+
+
+def get_decisiontable(routingdepot='0142'):
+    """Return the process wide DecisionTable for routingdepot."""
+    return routedata_registry.get_decisiontable(routingdepot)
+
+
+def reload(background=False):
+    """Drop all process wide RouteData objects, e.g. after updating the routing tables.
+
+    With background=True the new version is prepared in a thread which is returned, see
+    RouteDataRegistry.reload()."""
+    return routedata_registry.reload(background)
+
+
+# postcode prefixes naming a different country, by the country of the destination
+COUNTRY_SWITCHES = {
+    'DE': (('CH-', 'CH'), ('BE-', 'BE'), ('B-', 'BE'), ('AT-', 'AT'), ('A-', 'AT')),
+}
+
+
+class PostcodeNormalizer(object):
+    """Removes spaces and country prefixes from postcodes.
+
+    The prefix rules for a country are compiled once into a dict mapping the first character of each
+    prefix to the (prefix, country, length) rules starting with it, in the order they are tried: a dash,
+    the country itself, its ISO2CAR code and the prefixes in COUNTRY_SWITCHES. normalize() applies the
+    first matching rule until none matches, most postcodes need a single dict lookup.
+    """
+
+    # compiled tables are kept for at most this many different country values
+    MAXTABLES = 1024
+
+    def __init__(self):
+        self.tables = {}
+
+    def compile(self, country):
+        """Return the prefix rules for country."""
+        upper = country.upper()
+        rules = [('-', country, 1), (upper, country, len(country))]
+        if upper in ISO2CAR:
+            rules.append((ISO2CAR[upper], country, len(ISO2CAR[upper])))
+        rules.extend([(prefix, switched, len(prefix))
+                      for prefix, switched in COUNTRY_SWITCHES.get(upper, ())])
+        table = {}
+        for rule in rules:
+            # an empty country is no prefix
+            if rule[0]:
+                table.setdefault(rule[0][0], []).append(rule)
+        table = dict((char, tuple(charrules)) for char, charrules in table.items())
+        if len(self.tables) < self.MAXTABLES:
+            self.tables[country] = table
+        return table
+
+    def normalize(self, country, postcode):
+        """Return (country, postcode) with spaces and country prefixes removed from postcode.
+
+        >>> PostcodeNormalizer().normalize('DE', ' a-4240 ')
+        ('AT', '4240')
+        """
+        tables = self.tables
+        while postcode:
+            postcode = postcode.replace(' ', '').strip()
+            upper = postcode.upper()
+            table = tables.get(country)
+            if table is None:
+                table = self.compile(country)
+            for prefix, switched, length in table.get(upper[:1], ()):
+                if upper.startswith(prefix):
+                    country, postcode = switched, postcode[length:]
+                    break
+            else:
+                break
+        return country, postcode
+
+    def normalize_many(self, pairs):
+        """Return a list with the normalized (country, postcode) of each pair in pairs."""
+        normalize = self.normalize
+        return [normalize(country, postcode) for country, postcode in pairs]
+
+
+postcode_normalizer = PostcodeNormalizer()
+
+
+def normalize_postcode(country, postcode):
+    """Return (country, postcode) with spaces and country prefixes removed from postcode."""
+    return postcode_normalizer.normalize(country, postcode)
+
+
+def normalize_postcodes(pairs):
+    """Normalize a sequence of (country, postcode) pairs, returns a list of pairs."""
+    return postcode_normalizer.normalize_many(pairs)
 
 
 class Router(object):
-    """Routes parcels."""
+    """Routes parcels.
+
+    A Router keeps no state between or during calls to route(), so a single instance can be used by
+    several threads at once."""
 
     def __init__(self, data):
         self.route_data = data
-        self.db = self.route_data.db
 
-    def route(self, parcel):
-        """Find route."""
-
-        self.current_subset = []
-        self.conditions = ['1=1']
-        self.cleanup_postcode(parcel)
-
-        self.select_country(parcel)
+    def route(self, destination):
+        """Find route. destination is not modified."""
+
+        measure = metrics.enabled
+        if measure:
+            start = lap = clock()
+        parcel = self.cleanup_postcode(destination)
+        if measure:
+            lap = metrics.lap('route.cleanup', lap)
+        conditions = [self.select_country(parcel)]
+        if measure:
+            lap = metrics.lap('route.country', lap)
         if parcel.postcode is None:
             parcel.postcode = self.route_data.translate_location(parcel.city, parcel.country)
-            self.subsetstack.append(self.subset)
-
-        self.select_postcode(parcel)
-        self.select_service(parcel)
-        self.select_depot(parcel)
+            if measure:
+                lap = metrics.lap('route.location', lap)
+
+        self.select_postcode(parcel, conditions)
+        if measure:
+            lap = metrics.lap('route.postcode', lap)
+        rows = self.select_service(parcel, conditions)
+        if measure:
+            lap = metrics.lap('route.service', lap)
+        self.select_depot(parcel, rows)
+        if measure:
+            metrics.lap('route.depot', lap)
         # Sending date is not used yet, according to documentation
 
         # If there are several routes, always use the first one.
         # In prior versions, an exception was raised instead.
-        if len(self.current_subset) >= 1:
-            rows = self.select_routes("1=1")
-            (service_text, service_mark) = self.route_data.get_service(parcel.service)[1:3]
-            depot = self.route_data.get_depot(rows[0][8])
-            iata_code = depot[1]
-            country = depot[9]
-            if not country:
-                country = parcel.country
-            serviceinfo = self.route_data.get_servicetext(parcel.service)
-
-            return Route(rows[0][8], rows[0][7], rows[0][10], rows[0][9], rows[0][11],
-                         iata_code, service_text, service_mark, country,
-                         serviceinfo, self.route_data.get_countrynum(country),
-                         self.route_data.version, parcel.postcode)
-        raise NoRouteError("No route found for %r|%r|%r" % \
-              (parcel.country, parcel.postcode, parcel.service))
-
-    def add_condition(self, condition):
-        self.conditions.append(condition)
-
-    def select_routes(self, condition, params=()):
-        """Find routes matching condition and currently selected subset of the routes table.
-        If routes are found, save their ids for narrowing future searches.
-        If no routes are found, do not change current subset.
-        """
-
-        subsetcondition = ' AND '.join(self.conditions)
-        cur = self.db.cursor()
-        cur.execute("SELECT * FROM routes WHERE %s AND %s" % (subsetcondition, condition), params)
-        rows = cur.fetchall()
-
-        # Save matched rows if there were any results
-        if rows:
-            self.add_condition(condition)
-        self.current_subset = [str(row[0]) for row in rows]
-        return rows
+        (service_text, service_mark) = self.route_data.get_service(parcel.service)[1:3]
+        depot = self.route_data.get_depot(rows[0][8])
+        iata_code = depot[1]
+        country = depot[9]
+        if not country:
+            country = parcel.country
+        serviceinfo = self.route_data.get_servicetext(parcel.service)
+
+        route = Route(rows[0][8], rows[0][7], rows[0][10], rows[0][9], rows[0][11],
+                      iata_code, service_text, service_mark, country,
+                      serviceinfo, self.route_data.get_countrynum(country),
+                      self.route_data.version, parcel.postcode)
+        if measure:
+            metrics.lap('route.total', start)
+        return route
+
+    def select_routes(self, conditions, params=()):
+        """Find routes matching all of conditions."""
+
+        cur = self.route_data.db.cursor()
+        cur.execute("SELECT * FROM routes WHERE %s" % ' AND '.join(conditions), params)
+        return cur.fetchall()
+
+    def routes_exist(self, conditions):
+        """Check if any route matches all of conditions."""
+
+        cur = self.route_data.db.cursor()
+        cur.execute("SELECT 1 FROM routes WHERE %s LIMIT 1" % ' AND '.join(conditions))
+        return cur.fetchone() is not None
 
     def select_country(self, parcel):
-        """Select all routes with the given country."""
-        rows = self.select_routes("DestinationCountry='%s'" % (parcel.country.upper().replace("'", ''), ))
-        if not rows:
+        """Return the condition selecting all routes with the given country."""
+        condition = "DestinationCountry='%s'" % (parcel.country.upper().replace("'", ''), )
+        if not self.routes_exist([condition]):
             raise CountryError("Country %s unknown" % parcel.country)
+        return condition
 
     def cleanup_postcode(self, parcel):
-        """Removes spaces and country prefixes from postcodes."""
-
-        if not parcel.postcode:
-            return
-        parcel.postcode = parcel.postcode.replace(' ', '').strip()
-        if parcel.postcode.startswith('-'):
-            parcel.postcode = parcel.postcode[1:]
-            self.cleanup_postcode(parcel)
-        if parcel.postcode.upper().startswith(parcel.country.upper()):
-            parcel.postcode = parcel.postcode[len(parcel.country):]
-            self.cleanup_postcode(parcel)
-        if parcel.country.upper() in ISO2CAR:
-            if parcel.postcode.upper().startswith(ISO2CAR[parcel.country.upper()]):
-                parcel.postcode = parcel.postcode[len(ISO2CAR[parcel.country.upper()]):]
-                self.cleanup_postcode(parcel)
-        if parcel.country.upper() == 'DE' and parcel.postcode.upper().startswith('CH-'):
-            parcel.country = 'CH'
-            parcel.postcode = parcel.postcode[2:]
-            self.cleanup_postcode(parcel)
-        if parcel.country.upper() == 'DE' and parcel.postcode.upper().startswith('BE-'):
-            parcel.country = 'BE'
-            parcel.postcode = parcel.postcode[2:]
-            self.cleanup_postcode(parcel)
-        if parcel.country.upper() == 'DE' and parcel.postcode.upper().startswith('B-'):
-            parcel.country = 'BE'
-            parcel.postcode = parcel.postcode[1:]
-            self.cleanup_postcode(parcel)
-        if parcel.country.upper() == 'DE' and parcel.postcode.upper().startswith('AT-'):
-            parcel.country = 'AT'
-            parcel.postcode = parcel.postcode[2:]
-            self.cleanup_postcode(parcel)
-        if parcel.country.upper() == 'DE' and parcel.postcode.upper().startswith('A-'):
-            parcel.country = 'AT'
-            parcel.postcode = parcel.postcode[1:]
-            self.cleanup_postcode(parcel)
-
-    def select_postcode(self, parcel):
-        """Select all routes matching the given postcode."""
-
-        # direct match
-        rows = self.select_routes("BeginPostCode='%s'" % parcel.postcode.replace("'", ''))
-        if not rows:
-            # range
-            rows = self.select_routes("BeginPostCode<='%s' AND EndPostCode>='%s'"
-                                       % (parcel.postcode.replace("'", ''), parcel.postcode.replace("'", '')))
-        if not rows:
-            # catch all
-            rows = self.select_routes("BeginPostCode=''")
-        if not rows:
-            raise NoRouteError("Postcode %r|%r unknown" % (parcel.country, parcel.postcode))
+        """Removes spaces and country prefixes from postcodes.
+
+        Returns a new Destination, parcel is not modified."""
 
-    def select_service(self, parcel):
+        country, postcode = postcode_normalizer.normalize(parcel.country, parcel.postcode)
+        return Destination(country, postcode, parcel.city, parcel.service)
+
+    # names of the postcode_conditions() for metrics
+    POSTCODE_LEVELS = ('exact', 'range', 'catchall')
+
+    def postcode_conditions(self, parcel):
+        """Return the conditions for routes matching the postcode exactly, by range and as catch all."""
+
+        postcode = parcel.postcode.replace("'", '')
+        return ["BeginPostCode='%s'" % postcode,
+                "BeginPostCode<='%s' AND EndPostCode>='%s'" % (postcode, postcode),
+                "BeginPostCode=''"]
+
+    def select_postcode(self, parcel, conditions):
+        """Check that there are routes matching the given postcode."""
+
+        for level, postcodequery in zip(self.POSTCODE_LEVELS, self.postcode_conditions(parcel)):
+            if self.routes_exist(conditions + [postcodequery]):
+                if metrics.enabled:
+                    metrics.count('postcode.' + level)
+                return
+        raise NoRouteError("Postcode %r|%r unknown" % (parcel.country, parcel.postcode))
+
+    def select_service(self, parcel, conditions):
         """Select all routes with the given service code."""
 
-        # we have to redo postcode query as a backoff strategy
-        self.conditions.pop()
-        postcodequeries = ["BeginPostCode='%s'" % parcel.postcode.replace("'", ''),
-            "BeginPostCode<='%s' AND EndPostCode>='%s'" % (parcel.postcode.replace("'", ''),
-                                                           parcel.postcode.replace("'", '')),
-            "BeginPostCode=''"]
-        for postcodequery in postcodequeries:
-            rows = self.select_routes("%s AND ServiceCodes LIKE '%%%s%%'" % (postcodequery, parcel.service))
+        # the postcode queries are repeated as a backoff strategy
+        servicequery = "id IN (SELECT route FROM route_services WHERE service='%s')" % (
+            str(parcel.service).replace("'", ''))
+        for level, postcodequery in zip(self.POSTCODE_LEVELS, self.postcode_conditions(parcel)):
+            rows = self.select_routes(conditions + [postcodequery, servicequery])
+            kind = 'service'
             if not rows:
                 # catch all
-                rows = self.select_routes("%s AND ServiceCodes = ''" % (postcodequery))
+                rows = self.select_routes(conditions + [postcodequery, "ServiceCodes = ''"])
+                kind = 'catchall'
             if rows:
+                if metrics.enabled:
+                    metrics.count('service.%s.%s' % (level, kind))
+                return rows
+        raise ServiceError("No route for service found %r|%r|%r unknown" % \
+            (parcel.country, parcel.postcode, parcel.service))
+
+    def select_depot(self, parcel, rows):
+        """Check that the routes in rows can be used from our routing depot."""
+        subset = "route IN (%s)" % ','.join([str(row[0]) for row in rows])
+        cur = self.route_data.db.cursor()
+        cur.execute("SELECT route FROM routedepots WHERE depot=? AND %s" % subset,
+                    (self.route_data.routingdepot, ))
+        found = cur.fetchall()
+        if not found:
+            cur.execute("SELECT route FROM routedepots WHERE %s" % (subset))
+            found = cur.fetchall()
+        if not found:
+            raise RoutingDepotError("No route found for %r|%r|%r|%r|%r" % \
+                  (parcel.country, parcel.postcode, parcel.service, self.route_data.routingdepot, subset))
+
+
+class _CountryIndex(object):
+    """Postcode index over the routes of a single destination country.
+
+    For each of the three postcode queries Router.select_postcode() uses - exact match, range and catch
+    all - this gives the matching row positions, sorted by route id. Range matches are precomputed for
+    every BeginPostCode/EndPostCode value and for every gap between two such values, so a range lookup is
+    a single bisect.
+    """
+
+    def __init__(self, entries):
+        """entries is a list of (BeginPostCode, EndPostCode, position) sorted by position."""
+        shared = {}
+
+        def intern(positions):
+            positions = tuple(sorted(positions))
+            return shared.setdefault(positions, positions)
+
+        exact = {}
+        for begin, end, position in entries:
+            exact.setdefault(begin, []).append(position)
+        self.exact = dict((begin, intern(positions)) for begin, positions in exact.items())
+        self.catchall = self.exact.get('', ())
+
+        self.points = sorted(set([entry[0] for entry in entries] + [entry[1] for entry in entries]))
+        pointindex = dict((point, i) for i, point in enumerate(self.points))
+        starting = [[] for _ in self.points]
+        ending = [[] for _ in self.points]
+        for begin, end, position in entries:
+            if begin <= end:
+                starting[pointindex[begin]].append(position)
+                ending[pointindex[end]].append(position)
+        # at[i] matches postcode == points[i], between[i] postcodes between points[i-1] and points[i]
+        self.at = []
+        self.between = [()]
+        active = set()
+        for i in range(len(self.points)):
+            active.update(starting[i])
+            self.at.append(intern(active))
+            active.difference_update(ending[i])
+            self.between.append(intern(active))
+
+    def levels(self, postcode):
+        """Return the row positions matching postcode exactly, by range and as catch all."""
+        i = bisect.bisect_left(self.points, postcode)
+        if i < len(self.points) and self.points[i] == postcode:
+            inrange = self.at[i]
+        else:
+            inrange = self.between[i]
+        return self.exact.get(postcode, ()), inrange, self.catchall
+
+
+def _typecode(count):
+    """Return the smallest array typecode for codes 0 ... count - 1."""
+    for typecode in ('B', 'H', 'L'):
+        if count <= 2 ** (8 * array(typecode).itemsize):
+            return typecode
+    return 'Q'
+
+
+class RouteStore(object):
+    """Compact storage for result columns of the routes table.
+
+    Columns like OSort or DDepot have few distinct values repeated over many rows. Each column keeps
+    its distinct values once in `values` and codes for the rows in the smallest fitting typed array.
+    store[position] decodes a row to a tuple, Route objects are built only for returned results.
+    """
+
+    def __init__(self, rows):
+        rows = list(rows)
+        width = len(rows[0]) if rows else 0
+        self.values = [[] for _ in range(width)]
+        codes = [[] for _ in range(width)]
+        for column in range(width):
+            known = {}
+            values = self.values[column]
+            append = codes[column].append
+            for row in rows:
+                value = row[column]
+                code = known.get(value)
+                if code is None:
+                    code = known[value] = len(values)
+                    values.append(value)
+                append(code)
+        self.codes = [array(_typecode(len(values)), column) for values, column in zip(self.values, codes)]
+
+    def __len__(self):
+        return len(self.codes[0]) if self.codes else 0
+
+    def __getitem__(self, position):
+        return tuple([values[codes[position]] for values, codes in zip(self.values, self.codes)])
+
+
+class RouteIndex(object):
+    """In-memory index of the routes table of a RouteData object.
+
+    route() gives the same results as Router.route() but does not query the database. The routes table is
+    loaded once and split by destination country, see _CountryIndex. Service selection checks the
+    service sets of the few candidate rows, depot selection uses a flag per row which is set for all rows
+    listed in the routedepots view.
+    """
+
+    def __init__(self, routedata):
+        start = clock()
+        self.route_data = routedata
+        self.router = Router(routedata)
+        cur = routedata.db.cursor()
+        cur.execute("""SELECT id, DestinationCountry, BeginPostCode, EndPostCode, ServiceCodes,
+                              OSort, DDepot, GroupingPriority, DSort, BarcodeID
+                       FROM routes ORDER BY id""")
+        rows = cur.fetchall()
+        self.ids = array('l', [row[0] for row in rows])
+        # the same as the route_services table, rows share equal service sets
+        servicesets = {'': frozenset()}
+        for row in rows:
+            if row[4] not in servicesets:
+                servicesets[row[4]] = frozenset(row[4].split(','))
+        self.services = [servicesets[row[4]] for row in rows]
+        # OSort, DDepot, GroupingPriority, DSort, BarcodeID
+        self.results = RouteStore([row[5:] for row in rows])
+
+        positions = dict((route, position) for position, route in enumerate(self.ids))
+        self.depotflags = bytearray(len(rows))
+        cur.execute("SELECT DISTINCT route FROM routedepots")
+        for (route, ) in cur.fetchall():
+            self.depotflags[positions[route]] = 1
+
+        entries = {}
+        for position, row in enumerate(rows):
+            entries.setdefault(row[1], []).append((row[2], row[3], position))
+        self.countries = dict((country, _CountryIndex(countryentries))
+                              for country, countryentries in entries.items())
+        if metrics.enabled:
+            metrics.lap('build.routeindex', start)
+
+    def route(self, destination):
+        """Find route. destination is not modified."""
+        parcel = self.router.cleanup_postcode(destination)
+
+        countryindex = self.countries.get(parcel.country.upper().replace("'", ''))
+        if countryindex is None:
+            raise CountryError("Country %s unknown" % parcel.country)
+        if parcel.postcode is None:
+            parcel.postcode = self.route_data.translate_location(parcel.city, parcel.country)
+
+        levels = countryindex.levels(parcel.postcode.replace("'", ''))
+        if not (levels[0] or levels[1] or levels[2]):
+            raise NoRouteError("Postcode %r|%r unknown" % (parcel.country, parcel.postcode))
+
+        # same backoff as Router.select_service()
+        service = str(parcel.service).replace("'", '')
+        services = self.services
+        for level in levels:
+            matched = [position for position in level if service in services[position]]
+            if not matched:
+                # catch all
+                matched = [position for position in level if not services[position]]
+            if matched:
                 break
-        if not rows:
+        else:
             raise ServiceError("No route for service found %r|%r|%r unknown" % \
                 (parcel.country, parcel.postcode, parcel.service))
 
-    def select_depot(self, parcel):
-        """Select all routes with the given depot."""
-        subset = "route IN (%s)" % ','.join([str(route) for route in self.current_subset])
-        cur = self.db.cursor()
-        cur.execute("SELECT route FROM routedepots WHERE depot=%s AND %s" % (self.route_data.routingdepot,
-                                                                             subset))
-        rows = cur.fetchall()
-        if not rows:
-            cur.execute("SELECT route FROM routedepots WHERE %s" % (subset))
-            rows = cur.fetchall()
-        if not rows:
+        depotflags = self.depotflags
+        if not [position for position in matched if depotflags[position]]:
             raise RoutingDepotError("No route found for %r|%r|%r|%r|%r" % \
-                  (parcel.country, parcel.postcode, parcel.service, self.route_data.routingdepot, subset))
-        self.current_subset = [str(row[0]) for row in rows]
-
-
-def get_route_without_cache(country=None, postcode=None, city=None, servicecode='101'):
-    router = Router(RouteData())
-    return router.route(Destination(country, postcode, city))
-
-
-def get_route(country=None, postcode=None, city=None, servicecode='101'):
-    # this includes somewhat overly complex caching
-    filename = ROUTES_DB_BASE + ('_cache.db')
-    cache_db = sqlite3.connect(filename, isolation_level=None)
-    cur = cache_db.cursor()
-    # ensure table exists
-    cur.execute("""SELECT COUNT(*)
-                 FROM sqlite_master
-                 WHERE type = 'table' AND name = 'routing_cache'""")
-    if not cur.fetchone()[0]:
-        logging.info("regenerating cache table")
-        cur.execute("""CREATE TABLE routing_cache
-        (country_postcode_servicecode TEXT PRIMARY KEY,
-        d_depot TEXT,
-        o_sort TEXT,
-        d_sort TEXT,
-        grouping_priority TEXT,
-        barcode_id TEXT,
-        iata_code TEXT,
-        service_text TEXT,
-        service_mark TEXT,
-        country TEXT,
-        serviceinfo TEXT,
-        countrynum TEXT,
-        routingtable_version TEXT,
-        postcode TEXT
-        )""")
-
-    # check if entry is cached
-    cur.execute("SELECT * FROM routing_cache WHERE country_postcode_servicecode='%s'"
-                 % ("%s_%s_%s" % (country, postcode, servicecode)))
-    rows = cur.fetchall()
-    if not rows:
-        # nothing found
-        route = get_route_without_cache(country, postcode, city, servicecode)
-        cur.execute("""INSERT INTO routing_cache
-                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                             ("%s_%s_%s" % (country, postcode, servicecode),
-                             route.d_depot,
-                             route.o_sort,
-                             route.d_sort,
-                             route.grouping_priority,
-                             route.barcode_id,
-                             route.iata_code,
-                             route.service_text,
-                             route.service_mark,
-                             route.country,
-                             route.serviceinfo,
-                             route.countrynum,
-                             route.routingtable_version,
-                             route.postcode))
-        # For some reason closing the cache generated occasionally runtime errors.
-        # cache_db.close()
-    else:
-        if len(rows) > 1:
-            raise RuntimeError("to many cache hits!")
-        route = Route(*rows[0][1:])
-    return route
+                  (parcel.country, parcel.postcode, parcel.service, self.route_data.routingdepot,
+                   "route IN (%s)" % ','.join([str(self.ids[position]) for position in matched])))
+        return self.make_route(parcel, matched[0])
+
+    def make_route(self, parcel, position):
+        """Build the Route object for the row at position."""
+        return _make_route(self.route_data, parcel, self.results[position])
+
+
+def _make_route(routedata, parcel, result):
+    """Build the Route object for result, a tuple of OSort, DDepot, GroupingPriority, DSort and BarcodeID."""
+    osort, ddepot, grouping_priority, dsort, barcode_id = result
+    (service_text, service_mark) = routedata.get_service(parcel.service)[1:3]
+    depot = routedata.get_depot(ddepot)
+    iata_code = depot[1]
+    country = depot[9]
+    if not country:
+        country = parcel.country
+    serviceinfo = routedata.get_servicetext(parcel.service)
+    return Route(ddepot, osort, dsort, grouping_priority, barcode_id,
+                 iata_code, service_text, service_mark, country,
+                 serviceinfo, routedata.get_countrynum(country),
+                 routedata.version, parcel.postcode)
+
+
+# decisions of DecisionTable which are not a route, -3 - n stands for the n-th RoutingDepotError
+_NO_POSTCODE = -1
+_NO_SERVICE = -2
+
+# magic, format, table version, routing depot, offsets of the table names, table offsets, results and
+# depot errors
+_DECISIONS_HEADER = struct.Struct('<4sI32s16sIIII')
+_UINT = struct.Struct('<I')
+_UINT_PAIR = struct.Struct('<II')
+_INT = struct.Struct('<i')
+
+
+def _pack_array(typecode, values):
+    """Return the little endian bytes of array(typecode, values)."""
+    packed = array(typecode, values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _pack_strings(strings):
+    """Pack strings as count, count + 1 offsets into the data and the UTF-8 encoded data."""
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = [0]
+    for data in encoded:
+        offsets.append(offsets[-1] + len(data))
+    return _UINT.pack(len(encoded)) + _pack_array('I', offsets) + b''.join(encoded)
+
+
+class _MappedStrings(object):
+    """Read access to strings packed by _pack_strings() at offset of buffer."""
+
+    def __init__(self, buffer, offset):
+        self.buffer = buffer
+        self.count = _UINT.unpack_from(buffer, offset)[0]
+        self.offsets = offset + 4
+        self.data = self.offsets + 4 * (self.count + 1)
+
+    def __len__(self):
+        return self.count
+
+    def raw(self, i):
+        start, end = _UINT_PAIR.unpack_from(self.buffer, self.offsets + 4 * i)
+        return self.buffer[self.data + start:self.data + end]
+
+    def __getitem__(self, i):
+        return self.raw(i).decode('utf-8')
+
+
+class _MappedRouteStore(object):
+    """Read access to a RouteStore packed by DecisionTable.save().
+
+    The few distinct values of each column are decoded on load, the codes are read from buffer."""
+
+    ITEMFORMATS = {1: struct.Struct('<B'), 2: struct.Struct('<H'), 4: struct.Struct('<I'),
+                   8: struct.Struct('<Q')}
+
+    def __init__(self, buffer, offset):
+        self.buffer = buffer
+        self.columns = []
+        count = _UINT.unpack_from(buffer, offset)[0]
+        for column in range(count):
+            valuesoffset, codesoffset, itemsize = struct.unpack_from('<IIB', buffer, offset + 4 + 9 * column)
+            values = _MappedStrings(buffer, valuesoffset)
+            self.columns.append(([values[i] for i in range(len(values))], codesoffset,
+                                 itemsize, self.ITEMFORMATS[itemsize]))
+
+    def __getitem__(self, position):
+        buffer = self.buffer
+        return tuple([values[itemformat.unpack_from(buffer, codesoffset + itemsize * position)[0]]
+                      for values, codesoffset, itemsize, itemformat in self.columns])
+
+
+class DecisionTable(object):
+    """Routing decisions of a RouteData object, compiled for every destination country and service.
+
+    The postcode space of each (country, service) pair is split into non-overlapping segments with the
+    same decision, so route() needs a single binary search. A segment starts at a postcode - key
+    postcode + '\\x00', covering just that postcode - or right after it - key postcode + '\\x01'. The
+    decision is the position of the route in `results` or a negative number for the error
+    Router.route() would raise. Services routed like any other service in a country use the table
+    stored for service None.
+
+    The tables depend on the routing depot. They are saved to a flat binary file next to the routing
+    database, stamped with the table version, and compiled only once per version. The file is mapped
+    read-only into memory and all lookups work on the mapped buffer, so processes using the same file
+    share its memory. The file contains little endian integers:
+
+        header          see _DECISIONS_HEADER
+        table names     "country|service" strings packed by _pack_strings(), service None as ''
+        table offsets   uint32 per table name
+        each table      uint32 count, int32 decisions[count], keys packed by _pack_strings()
+        results         uint32 columns, per column (uint32 values offset, uint32 codes offset,
+                        uint8 code size), values packed by _pack_strings(), codes
+        depot errors    route subsets for RoutingDepotError packed by _pack_strings()
+    """
+
+    MAGIC = b'DPDT'
+    FORMAT = 3
+
+    def __init__(self, routedata, routeindex=None, filename=None):
+        self.route_data = routedata
+        self.router = Router(routedata)
+        if filename is None:
+            filename = ROUTES_DB_BASE + ('-%s-%s.decisions' % (routedata.version, routedata.routingdepot))
+        self.filename = filename
+        if not self.load():
+            self.save(*self.compile(routeindex or RouteIndex(routedata)))
+            if not self.load():
+                raise InvalidFormatError("Can't read the compiled decision tables in %s" % self.filename)
+
+    def load(self):
+        """Map the compiled tables, returns False if there are none for this version and depot."""
+        try:
+            with open(self.filename, 'rb') as tablefile:
+                buffer = mmap.mmap(tablefile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return False
+        if len(buffer) < _DECISIONS_HEADER.size:
+            return False
+        (magic, fileformat, version, routingdepot, namesoffset, tablesoffset, resultsoffset,
+         depoterrorsoffset) = _DECISIONS_HEADER.unpack_from(buffer, 0)
+        if (magic, fileformat, version.rstrip(b'\x00'), routingdepot.rstrip(b'\x00')) != (
+                self.MAGIC, self.FORMAT, self.route_data.version.encode('utf-8'),
+                self.route_data.routingdepot.encode('utf-8')):
+            return False
+        self.buffer = buffer
+        names = _MappedStrings(buffer, namesoffset)
+        self.tables = {}
+        for i in range(len(names)):
+            country, service = names[i].split('|')
+            self.tables[(country, service or None)] = _UINT.unpack_from(buffer, tablesoffset + 4 * i)[0]
+        self.results = _MappedRouteStore(buffer, resultsoffset)
+        self.depoterrors = _MappedStrings(buffer, depoterrorsoffset)
+        return True
+
+    def save(self, results, depoterrors, tables):
+        """Write compiled tables next to the routing database."""
+        out = bytearray(_DECISIONS_HEADER.size)
+
+        tableoffsets = []
+        names = []
+        for (country, service), (keys, decisions) in tables.items():
+            names.append('%s|%s' % (country, service or ''))
+            tableoffsets.append(len(out))
+            out += _UINT.pack(len(keys)) + _pack_array('i', decisions) + _pack_strings(keys)
+        namesoffset = len(out)
+        out += _pack_strings(names)
+        tablesoffset = len(out)
+        out += _pack_array('I', tableoffsets)
+
+        columns = []
+        for values, codes in zip(results.values, results.codes):
+            valuesoffset = len(out)
+            out += _pack_strings(values)
+            codesoffset = len(out)
+            out += _pack_array(codes.typecode, codes)
+            columns.append(struct.pack('<IIB', valuesoffset, codesoffset, codes.itemsize))
+        resultsoffset = len(out)
+        out += _UINT.pack(len(columns)) + b''.join(columns)
+        depoterrorsoffset = len(out)
+        out += _pack_strings(depoterrors)
+
+        out[:_DECISIONS_HEADER.size] = _DECISIONS_HEADER.pack(
+            self.MAGIC, self.FORMAT, self.route_data.version.encode('utf-8'),
+            self.route_data.routingdepot.encode('utf-8'), namesoffset, tablesoffset, resultsoffset,
+            depoterrorsoffset)
+        tmpname = '%s.%d.tmp' % (self.filename, os.getpid())
+        with open(tmpname, 'wb') as tablefile:
+            tablefile.write(out)
+        os.rename(tmpname, self.filename)
+
+    def compile(self, routeindex):
+        """Compile the tables from the routes in routeindex.
+
+        Returns the RouteStore of the results, the list of depot errors and a dict mapping (country,
+        service) to a list of keys and an array of decisions."""
+        start = time.time()
+        self.depoterrors = []
+        self.depoterrorcodes = {}
+        self.tables = {}
+        for country, countryindex in routeindex.countries.items():
+            self.compile_country(routeindex, country, countryindex)
+        compiled = (routeindex.results, self.depoterrors, self.tables)
+        del self.depoterrors, self.depoterrorcodes, self.tables
+        if metrics.enabled:
+            metrics.record('build.decisiontable', time.time() - start)
+        logging.info("compiled %d decision tables for routing depot %s in %.1fs", len(compiled[2]),
+                     self.route_data.routingdepot, time.time() - start)
+        return compiled
+
+    def compile_country(self, routeindex, country, countryindex):
+        """Compile the tables of all services for a destination country."""
+        # (key, exact, inrange) for every elementary postcode segment, see _CountryIndex.levels()
+        segments = [('', (), countryindex.between[0])]
+        for i, point in enumerate(countryindex.points):
+            segments.append((point + '\x00', countryindex.exact.get(point, ()), countryindex.at[i]))
+            segments.append((point + '\x01', (), countryindex.between[i + 1]))
+
+        services = set()
+        for positions in itertools.chain(countryindex.exact.values(), countryindex.at, countryindex.between):
+            for position in positions:
+                services.update(routeindex.services[position])
+        services = [None] + sorted(services)
+
+        tables = dict((service, ([], array('l'))) for service in services)
+        decided = {}
+        for key, exact, inrange in segments:
+            levelkey = (id(exact), id(inrange))
+            if levelkey not in decided:
+                levels = (exact, inrange, countryindex.catchall)
+                decided[levelkey] = [self.decide(routeindex, levels, service) for service in services]
+            for service, decision in zip(services, decided[levelkey]):
+                keys, decisions = tables[service]
+                # merge segments with the same decision
+                if not decisions or decisions[-1] != decision:
+                    keys.append(key)
+                    decisions.append(decision)
+        # services routed like any other service need no table of their own
+        default = tables.pop(None)
+        self.tables[(country, None)] = default
+        for service, table in tables.items():
+            if table != default:
+                self.tables[(country, service)] = table
+
+    def decide(self, routeindex, levels, service):
+        """Return the decision for a postcode matching levels, see RouteIndex.route()."""
+        if not (levels[0] or levels[1] or levels[2]):
+            return _NO_POSTCODE
+        services = routeindex.services
+        for level in levels:
+            matched = [position for position in level if service in services[position]]
+            if not matched:
+                # catch all
+                matched = [position for position in level if not services[position]]
+            if matched:
+                break
+        else:
+            return _NO_SERVICE
+        depotflags = routeindex.depotflags
+        if not [position for position in matched if depotflags[position]]:
+            subset = "route IN (%s)" % ','.join([str(routeindex.ids[position]) for position in matched])
+            if subset not in self.depoterrorcodes:
+                self.depoterrors.append(subset)
+                self.depoterrorcodes[subset] = -2 - len(self.depoterrors)
+            return self.depoterrorcodes[subset]
+        return matched[0]
+
+    def decision(self, table, postcode):
+        """Return the decision for postcode from the table at offset table of the mapped buffer."""
+        buffer = self.buffer
+        count = _UINT.unpack_from(buffer, table)[0]
+        keysoffsets = table + 4 + 4 * count + 4
+        keysdata = keysoffsets + 4 * (count + 1)
+        key = (postcode + '\x00').encode('utf-8')
+        # bisect_right over the keys
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            start, end = _UINT_PAIR.unpack_from(buffer, keysoffsets + 4 * middle)
+            if key < buffer[keysdata + start:keysdata + end]:
+                high = middle
+            else:
+                low = middle + 1
+        return _INT.unpack_from(buffer, table + 4 + 4 * (low - 1))[0]
+
+    def route(self, destination):
+        """Find route. destination is not modified."""
+        parcel = self.router.cleanup_postcode(destination)
+
+        country = parcel.country.upper().replace("'", '')
+        if (country, None) not in self.tables:
+            raise CountryError("Country %s unknown" % parcel.country)
+        if parcel.postcode is None:
+            parcel.postcode = self.route_data.translate_location(parcel.city, parcel.country)
+
+        table = self.tables.get((country, str(parcel.service).replace("'", '')))
+        if table is None:
+            table = self.tables[(country, None)]
+        decision = self.decision(table, parcel.postcode.replace("'", ''))
+        if decision >= 0:
+            return _make_route(self.route_data, parcel, self.results[decision])
+        if decision == _NO_POSTCODE:
+            raise NoRouteError("Postcode %r|%r unknown" % (parcel.country, parcel.postcode))
+        if decision == _NO_SERVICE:
+            raise ServiceError("No route for service found %r|%r|%r unknown" % \
+                (parcel.country, parcel.postcode, parcel.service))
+        raise RoutingDepotError("No route found for %r|%r|%r|%r|%r" % \
+              (parcel.country, parcel.postcode, parcel.service, self.route_data.routingdepot,
+               self.depoterrors[-3 - decision]))
+
+
+def get_route_without_cache(country=None, postcode=None, city=None, servicecode='101', routingdepot='0142'):
+    router = Router(get_routedata(routingdepot))
+    return router.route(Destination(country, postcode, city, servicecode))
+
+
+def route_many(destinations, routingdepot='0142'):
+    """Route a batch of destinations.
+
+    destinations can be Destination objects or (country, postcode, city, servicecode) tuples, city and
+    servicecode may be left out. Destinations are compared after normalizing the postcode and upper
+    casing the country, the city only counts if there is no postcode. Every distinct destination is
+    routed only once using the process wide RouteIndex. Returns a list in input order with a Route
+    object or the GeorouteException raised for each destination. Equal destinations share the same
+    Route object.
+    """
+    index = get_routeindex(routingdepot)
+    normalize = postcode_normalizer.normalize
+    defaults = (None, '101')
+    results = {}
+    ret = []
+    for destination in destinations:
+        if isinstance(destination, Destination):
+            country, postcode, city, service = (destination.country, destination.postcode,
+                                                destination.city, destination.service)
+        else:
+            destination = tuple(destination)
+            country, postcode, city, service = destination + defaults[len(destination) - 2:]
+        country, postcode = normalize(country, postcode)
+        if country:
+            country = country.upper()
+        key = (country, postcode, city if postcode is None else None, service)
+        result = results.get(key)
+        if result is None:
+            try:
+                result = index.route(Destination(*key))
+            except GeorouteException as exception:
+                result = exception
+            results[key] = result
+        ret.append(result)
+    return ret
+
+
+ROUTE_FIELDS = Route.__slots__
+
+
+def _cache_key(value):
+    """Encode a destination value for the route cache key.
+
+    Strings get a '=' prefix, other values are stored as their repr(), so None, '' and 101 stay apart -
+    they route differently."""
+    if isinstance(value, str):
+        return '=' + value
+    return repr(value)
+
+
+class RouteCache(object):
+    """Cache for get_route() results.
+
+    An in-process LRU of at most maxsize entries sits in front of a persistent SQLite cache shared
+    between processes. The SQLite connection is opened once and reused. Entries are keyed by table
+    version, routing depot, country, postcode, city and service code. When the routing table version
+    changes, the LRU is cleared and entries of older versions are dropped from the database.
+    """
+
+    def __init__(self, filename=None, maxsize=10000):
+        self.filename = filename
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.lru = collections.OrderedDict()
+        self.version = None
+        self.db = None
+        self.hits = self.misses = 0
+
+    def connect(self):
+        """Open the cache database and create the cache table if needed."""
+        if self.filename is None:
+            self.filename = ROUTES_DB_BASE + '_cache.db'
+        self.db = sqlite3.connect(self.filename, isolation_level=None, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS route_cache (
+                           version TEXT, routingdepot TEXT, destination_country TEXT,
+                           destination_postcode TEXT, city TEXT, servicecode TEXT, %s,
+                           PRIMARY KEY (version, routingdepot, destination_country, destination_postcode,
+                                        city, servicecode))""" % ', '.join(ROUTE_FIELDS))
+
+    def evict(self, version):
+        """Switch to routing table version.
+
+        The LRU is cleared. In the shared database only entries of older versions are dropped, other
+        processes may still use the previous version or already a newer one."""
+        self.lru.clear()
+        self.db.execute("DELETE FROM route_cache WHERE version < ?", (version, ))
+        self.version = version
+
+    def clear(self):
+        """Drop all entries."""
+        with self.lock:
+            self.lru.clear()
+            if self.db is not None:
+                self.db.execute("DELETE FROM route_cache")
+
+    def get(self, country, postcode, city, servicecode, routingdepot='0142'):
+        """Return the cached Route, calling get_route_without_cache() for routingdepot on a miss."""
+        if metrics.enabled:
+            start = clock()
+        version = routedata_registry.current_version()
+        key = (version, routingdepot) + tuple(map(_cache_key, (country, postcode, city, servicecode)))
+        with self.lock:
+            if self.db is None:
+                self.connect()
+            if version != self.version:
+                self.evict(version)
+            values = self.lru.get(key)
+            if values is not None:
+                self.lru.move_to_end(key)
+                if metrics.enabled:
+                    metrics.count('cache.hit.memory')
+            else:
+                values = self.db.execute("""SELECT %s FROM route_cache
+                                            WHERE version=? AND routingdepot=? AND destination_country=?
+                                            AND destination_postcode=? AND city=? AND servicecode=?"""
+                                         % ', '.join(ROUTE_FIELDS), key).fetchone()
+                if values is not None:
+                    self.remember(key, values)
+                if metrics.enabled:
+                    metrics.count('cache.hit.db' if values is not None else 'cache.miss')
+            if values is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if metrics.enabled:
+            metrics.lap('cache.lookup', start)
+        if values is not None:
+            return Route(*values)
+        route = get_route_without_cache(country, postcode, city, servicecode, routingdepot)
+        values = tuple([getattr(route, field) for field in ROUTE_FIELDS])
+        with self.lock:
+            if version == self.version and route.routingtable_version == version:
+                self.db.execute("INSERT OR REPLACE INTO route_cache VALUES (%s)"
+                                % ', '.join(['?'] * (len(key) + len(values))), key + values)
+                self.remember(key, values)
+        return route
+
+    def put_many(self, routes, routingdepot='0142'):
+        """Store many routes in one transaction.
+
+        routes is a list of ((country, postcode, city, servicecode), Route) pairs. Only routes of the
+        current table version are stored, returns their number."""
+        version = routedata_registry.current_version()
+        rows = []
+        for (country, postcode, city, servicecode), route in routes:
+            if route.routingtable_version == version:
+                rows.append((version, routingdepot)
+                            + tuple(map(_cache_key, (country, postcode, city, servicecode)))
+                            + tuple([getattr(route, field) for field in ROUTE_FIELDS]))
+        with self.lock:
+            if self.db is None:
+                self.connect()
+            if version != self.version:
+                self.evict(version)
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany("INSERT OR REPLACE INTO route_cache VALUES (%s)"
+                                    % ', '.join(['?'] * (6 + len(ROUTE_FIELDS))), rows)
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+        return len(rows)
+
+    def remember(self, key, values):
+        """Put values into the LRU, dropping the least recently used entry if it is full."""
+        self.lru[key] = values
+        if len(self.lru) > self.maxsize:
+            self.lru.popitem(last=False)
+
+
+route_cache = RouteCache()
+
+
+def get_route(country=None, postcode=None, city=None, servicecode='101', routingdepot='0142'):
+    """Like get_route_without_cache() but results are cached, see RouteCache."""
+    return route_cache.get(country, postcode, city, servicecode, routingdepot)
 
 
 # compability layer to old georoute code prior to huLOG revision 1710
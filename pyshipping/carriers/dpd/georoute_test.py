@@ -3,11 +3,27 @@
 
 """Test routing resolver for DPD. Coded by jmv, extended by md"""
 
+import fcntl
+import gzip
+import mmap
+import multiprocessing
+import os
+import pickle
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
 import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pyshipping.carriers.dpd import benchmark, georoute, warmup
 from pyshipping.carriers.dpd.georoute import get_route, get_route_without_cache
 from pyshipping.carriers.dpd.georoute import RouteData, Router, Destination
 from pyshipping.carriers.dpd.georoute import ServiceError, CountryError, TranslationError
+from pyshipping.carriers.dpd.georoute import RouteDataRegistry, get_routedata, get_routeindex
+from pyshipping.carriers.dpd.georoute import get_decisiontable, metrics, Route, RouteStore, DecisionTable
+from pyshipping.carriers.dpd.georoute import GeorouteException, route_many, RouteCache, normalize_location
 
 
 class TestCase(unittest.TestCase):
@@ -67,6 +83,55 @@ class RouteDataTest(TestCase):
         rows = c.fetchall()
         self.assertEqual(1, len(rows))
 
+    def test_connections(self):
+        self.assertTrue(self.data.db is self.db)
+        self.assertRaises(sqlite3.OperationalError, self.db.execute, "DELETE FROM depots")
+        pool = ThreadPoolExecutor(1)
+        other = pool.submit(lambda: self.data.db).result()
+        self.assertFalse(other is self.db)
+        c = other.cursor()
+        c.execute("SELECT COUNT(*) FROM routedepots WHERE depot='0142'")
+        self.assertTrue(c.fetchone()[0] > 0)
+        pool.shutdown()
+        # the connection of the ended thread is used again
+        self.assertTrue(other in self.data.connections.idle)
+        used = []
+        thread = threading.Thread(target=lambda: used.append(self.data.db))
+        thread.start()
+        thread.join()
+        self.assertEqual(used, [other])
+
+    def test_routedepots_view(self):
+        other = RouteData('0015')
+        self.assertEqual(other.version, self.data.version)
+        c = self.db.cursor()
+        c.execute("SELECT COUNT(*) FROM routedepots WHERE depot='0142'")
+        self.assertTrue(c.fetchone()[0] > 0)
+        c = other.db.cursor()
+        c.execute("SELECT COUNT(*) FROM routedepots WHERE depot='0142'")
+        self.assertEqual(c.fetchone()[0], 0)
+        c.execute("SELECT COUNT(*) FROM routedepots WHERE depot=''")
+        self.assertTrue(c.fetchone()[0] > 0)
+
+    def test_expand_routingplaces(self):
+        self.assertEqual(self.data.expand_routingplaces(1, ''), [(1, '', '', '')])
+        self.assertEqual(self.data.expand_routingplaces(2, 'CDE,D01000199,D0142,GCHRF'),
+                         [(2, 'C', 'DE', 'DE'), (2, 'D', '0100', '0199'), (2, 'D', '0142', '0142'),
+                          (2, 'G', 'CHRF', 'CHRF')])
+
+    def test_route_services(self):
+        c = self.db.cursor()
+        c.execute("""SELECT id, ServiceCodes FROM routes
+                     WHERE DestinationCountry='DE' AND ServiceCodes != '' LIMIT 1""")
+        route, servicecodes = c.fetchone()
+        c.execute("SELECT service FROM route_services WHERE route=? ORDER BY service", (route, ))
+        self.assertEqual([row[0] for row in c.fetchall()], sorted(servicecodes.split(',')))
+        # services are matched exactly, not by substring
+        c.execute("SELECT COUNT(*) FROM routes WHERE ServiceCodes LIKE '%10%'")
+        self.assertTrue(c.fetchone()[0] > 0)
+        c.execute("SELECT COUNT(*) FROM route_services WHERE service='10'")
+        self.assertEqual(c.fetchone()[0], 0)
+
     def test_get_service(self):
         self.assertEqual(self.data.get_service('180'), ('180', 'AM1-NO', '', '022,160', ''))
         self.assertRaises(ServiceError, self.data.get_service, '100000')
@@ -79,6 +144,218 @@ class RouteDataTest(TestCase):
         self.assertEqual('1', self.data.translate_location('Dublin', 'IE'))
         self.assertRaises(TranslationError, self.data.translate_location, 'Cahir', 'IE')
 
+    def test_translate_location_normalized(self):
+        self.assertEqual('1', self.data.translate_location(' DUBLIN ', 'ie'))
+        self.assertEqual('2', self.data.translate_location("Reste de l'Irlande  (sauf Dublin)", 'IE'))
+        self.assertEqual(normalize_location(u'M\u00fcnchen'), normalize_location(u'MUNCHEN'))
+        self.assertRaises(TranslationError, self.data.translate_location, None, 'IE')
+        translated = self.data.translate_locations([('Dublin', 'IE'), ('Cahir', 'IE'), ('dublin', 'DE')])
+        self.assertEqual(translated[0], '1')
+        self.assertTrue(isinstance(translated[1], TranslationError))
+        self.assertTrue(isinstance(translated[2], TranslationError))
+
+    def test_search_location(self):
+        self.assertEqual(self.data.locations.search('ir', 'IE'),
+                         [('Ireland excluding Dublin', 'IE', '2'), ('Irland ohne Dublin', 'IE', '2')])
+        self.assertEqual(self.data.locations.search('Dub'), [('Dublin', 'IE', '1')])
+        self.assertEqual(self.data.locations.search('Dub', 'DE'), [])
+
+
+class BuildDatabaseTest(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.old_base = georoute.ROUTES_DB_BASE
+        georoute.ROUTES_DB_BASE = os.path.join(self.tempdir, 'dpdroutes')
+
+    def tearDown(self):
+        georoute.ROUTES_DB_BASE = self.old_base
+        shutil.rmtree(self.tempdir)
+
+    def test_build(self):
+        progress = []
+        data = RouteData(progress=lambda table, rows: progress.append((table, rows)))
+        self.assertTrue(data.buildtime > 0)
+        self.assertEqual([table for table, rows in progress if table != 'routes'],
+                         ['depots', 'location', 'route_services'])
+        c = data.db.cursor()
+        c.execute("SELECT COUNT(*) FROM routes")
+        routes = [entry for entry in progress if entry[0] == 'routes']
+        self.assertEqual(('routes', c.fetchone()[0]), routes[-1])
+        self.assertEqual(RouteData().buildtime, None)
+
+    def test_readfile_batches(self):
+        for name in ('COUNTRY', 'DEPOTS', 'ROUTES'):
+            filename = os.path.join(georoute.ROUTETABLES_BASE, name)
+            batches = list(georoute._readfile_batches(filename, 5000))
+            self.assertTrue(all(len(batch) == 5000 for batch in batches[:-1]))
+            self.assertEqual([line for batch in batches for line in batch],
+                             list(georoute._readfile(filename)))
+
+    def test_readfile_batches_blocks(self):
+        # comments and lines crossing block boundaries
+        content = b'a|b|\n#comment|x|y\nc|d|\n  #indented|comment\nexample|e|\n\n#|\nf|g'
+        filename = os.path.join(self.tempdir, 'ROUTES')
+        old_blocksize = georoute.READ_BLOCKSIZE
+        try:
+            for name in (filename, filename + '.gz'):
+                with open(name, 'wb') as fhandle:
+                    fhandle.write(gzip.compress(content) if name.endswith('.gz') else content)
+                expected = list(georoute._readfile(filename))
+                self.assertEqual(len(expected), 5)
+                for blocksize in range(1, len(content) + 2):
+                    georoute.READ_BLOCKSIZE = blocksize
+                    batches = georoute._readfile_batches(filename, 2)
+                    self.assertEqual([line for batch in batches for line in batch], expected)
+        finally:
+            georoute.READ_BLOCKSIZE = old_blocksize
+
+    def test_readfile_batches_gzip(self):
+        filename = os.path.join(self.tempdir, 'ROUTES')
+        content = b'#Version: 1\r\nAT|1010|\n\n  \xc4T|10\n#\nDE|1'
+        with open(filename + '.gz', 'wb') as fhandle:
+            # concatenated gzip members are one file
+            fhandle.write(gzip.compress(content[:20]) + gzip.compress(content[20:]))
+        self.assertEqual(list(georoute._readfile_batches(filename, 2)),
+                         [[['AT', '1010', ''], ['']], [['\xc4T', '10'], ['DE', '1']]])
+        self.assertEqual([line for batch in georoute._readfile_batches(filename, 2) for line in batch],
+                         list(georoute._readfile(filename)))
+
+
+def _build_in_process(base):
+    georoute.ROUTES_DB_BASE = base
+    return RouteData().buildtime
+
+
+class BuildLockTest(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.old_base = georoute.ROUTES_DB_BASE
+        georoute.ROUTES_DB_BASE = os.path.join(self.tempdir, 'dpdroutes')
+
+    def tearDown(self):
+        georoute.ROUTES_DB_BASE = self.old_base
+        shutil.rmtree(self.tempdir)
+
+    def test_processes(self):
+        pool = multiprocessing.Pool(3)
+        try:
+            buildtimes = pool.map(_build_in_process, [georoute.ROUTES_DB_BASE] * 3)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(len([buildtime for buildtime in buildtimes if buildtime]), 1)
+        self.assertEqual(sorted(os.listdir(self.tempdir)),
+                         ['dpdroutes-%s.db' % georoute.read_version(),
+                          'dpdroutes-%s.db.lock' % georoute.read_version()])
+
+    def test_previous_version(self):
+        filename = georoute.ROUTES_DB_BASE + '-%s.db' % georoute.read_version()
+        RouteData()
+        os.rename(filename, georoute.ROUTES_DB_BASE + '-OLD.db')
+        # the previous version has other service and depot data
+        db = sqlite3.connect(georoute.ROUTES_DB_BASE + '-OLD.db')
+        select = "SELECT content FROM tablefiles WHERE name=?"
+        service = db.execute(select, ('SERVICE', )).fetchone()[0]
+        service = service.replace(b'#Version: ' + georoute.read_version().encode('ascii'), b'#Version: OLD')
+        depots = gzip.decompress(db.execute(select, ('DEPOTS.gz', )).fetchone()[0])
+        db.execute("UPDATE tablefiles SET content=? WHERE name='SERVICE'",
+                   (service.replace(b'\n101|D|', b'\n101|X|'), ))
+        db.execute("UPDATE tablefiles SET content=? WHERE name='DEPOTS.gz'",
+                   (gzip.compress(depots.replace(b'\n0142||', b'\n0142|WUP|')), ))
+        db.commit()
+        db.close()
+        with open(filename + '.lock', 'a') as lockfile:
+            # another process is building the current version
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            data = RouteData(wait=False)
+        self.assertEqual(data.version, 'OLD')
+        self.assertEqual(data.buildtime, None)
+        self.assertFalse(os.path.exists(filename))
+        route = Router(data).route(Destination('DE', '42477'))
+        self.assertEqual((route.routingtable_version, route.service_text, route.iata_code),
+                         ('OLD', 'X', 'WUP'))
+        self.assertEqual(data.get_service('101')[1], 'X')
+        # the installed tables are unchanged
+        self.assertEqual(Router(RouteData()).route(Destination('DE', '42477')).service_text, 'D')
+
+
+class RouteDataRegistryTest(TestCase):
+
+    def test_shared(self):
+        self.assertTrue(get_routedata() is get_routedata('0142'))
+        self.assertEqual(get_routedata().routingdepot, '0142')
+
+    def test_reload(self):
+        registry = RouteDataRegistry()
+        data = registry.get()
+        self.assertTrue(registry.get() is data)
+        registry.reload()
+        self.assertFalse(registry.get() is data)
+        self.assertEqual(registry.get().version, data.version)
+
+
+class BackgroundReloadTest(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.old_paths = georoute.ROUTETABLES_BASE, georoute.ROUTES_DB_BASE
+        self.tables = os.path.join(self.tempdir, 'georoutetables')
+        os.mkdir(self.tables)
+        for name in os.listdir(georoute.ROUTETABLES_BASE):
+            if name != 'SERVICE':
+                os.symlink(os.path.join(georoute.ROUTETABLES_BASE, name), os.path.join(self.tables, name))
+        self.write_service('TEST1')
+        georoute.ROUTETABLES_BASE = self.tables
+        georoute.ROUTES_DB_BASE = os.path.join(self.tempdir, 'dpdroutes')
+
+    def tearDown(self):
+        georoute.ROUTETABLES_BASE, georoute.ROUTES_DB_BASE = self.old_paths
+        shutil.rmtree(self.tempdir)
+
+    def write_service(self, version):
+        lines = open(os.path.join(self.old_paths[0], 'SERVICE')).readlines()
+        out = open(os.path.join(self.tables, 'SERVICE'), 'w')
+        for line in lines:
+            if line.startswith('#Version: '):
+                line = '#Version: %s\n' % version
+            out.write(line)
+        out.close()
+
+    def test_switch(self):
+        registry = RouteDataRegistry()
+        index = registry.get_index()
+        self.assertEqual(index.route_data.version, 'TEST1')
+        self.write_service('TEST2')
+        thread = registry.reload(background=True)
+        # the old version is served until the new one is ready
+        self.assertTrue(registry.get_index() is index or registry.get().version == 'TEST2')
+        thread.join()
+        self.assertEqual(registry.version, 'TEST2')
+        self.assertEqual(registry.get().version, 'TEST2')
+        self.assertEqual(registry.get_index().route_data.version, 'TEST2')
+        new = vars(registry.get_index().route(Destination('DE', '42477')))
+        old = vars(index.route(Destination('DE', '42477')))
+        self.assertEqual(new.pop('routingtable_version'), 'TEST2')
+        self.assertEqual(old.pop('routingtable_version'), 'TEST1')
+        self.assertEqual(new, old)
+        self.assertFalse(registry.prepare())
+
+    def test_invalid(self):
+        registry = RouteDataRegistry()
+        data = registry.get()
+        self.write_service('BROKEN')
+        os.remove(os.path.join(self.tables, 'ROUTES.gz'))
+        gzip.open(os.path.join(self.tables, 'ROUTES.gz'), 'wb').close()
+        self.assertFalse(registry.prepare())
+        self.assertEqual(registry.version, 'TEST1')
+        self.assertTrue(registry.get() is data)
+        # the broken database is not kept for the next attempt
+        self.assertEqual([name for name in os.listdir(self.tempdir)
+                          if 'BROKEN' in name and not name.endswith('.lock')], [])
+        self.assertRaises(georoute.InvalidFormatError, RouteData)
+
 
 class RouterTest(TestCase):
 
@@ -434,15 +711,330 @@ class RouterTest(TestCase):
     def test_incorrectService(self):
         self.assertRaises(ServiceError, get_route, 'DE', '0001')
 
+    def test_odd_routingdepots(self):
+        def route(func, destination):
+            try:
+                return vars(func(destination))
+            except GeorouteException as exception:
+                return (exception.__class__.__name__, str(exception))
+
+        destination = Destination('DE', '42477')
+        for depot in ('ABC', '0142 OR 1', "0142'"):
+            self.assertEqual(route(Router(get_routedata(depot)).route, destination),
+                             route(get_routeindex(depot).route, destination))
+
     def test_select_routes(self):
-        self.router.conditions = ['1=1']
-        rows = self.router.select_routes('DestinationCountry=?', ('UZ', ))
+        rows = self.router.select_routes(['DestinationCountry=?'], ('UZ', ))
         self.assertTrue(len(rows) > 0)
 
+    def test_cleanup_postcode(self):
+        destination = Destination('DE', ' a-4240 ')
+        parcel = self.router.cleanup_postcode(destination)
+        self.assertEqual((parcel.country, parcel.postcode), ('AT', '4240'))
+        self.assertEqual((destination.country, destination.postcode), ('DE', ' a-4240 '))
+        parcel = self.router.cleanup_postcode(Destination('CH', 'CH-8440'))
+        self.assertEqual((parcel.country, parcel.postcode), ('CH', '8440'))
+        self.assertEqual(self.router.cleanup_postcode(Destination('DE', None)).postcode, None)
+
+    def test_normalize_postcodes(self):
+        def cleanup(country, postcode):
+            # the recursive rules normalize_postcode() replaces
+            if not postcode:
+                return country, postcode
+            postcode = postcode.replace(' ', '').strip()
+            if postcode.startswith('-'):
+                country, postcode = cleanup(country, postcode[1:])
+            if postcode.upper().startswith(country.upper()):
+                country, postcode = cleanup(country, postcode[len(country):])
+            if country.upper() in georoute.ISO2CAR:
+                if postcode.upper().startswith(georoute.ISO2CAR[country.upper()]):
+                    car = georoute.ISO2CAR[country.upper()]
+                    country, postcode = cleanup(country, postcode[len(car):])
+            for prefix, switched in (('CH-', 'CH'), ('BE-', 'BE'), ('B-', 'BE'), ('AT-', 'AT'), ('A-', 'AT')):
+                if country.upper() == 'DE' and postcode.upper().startswith(prefix):
+                    country, postcode = cleanup(switched, postcode[len(prefix) - 1:])
+            return country, postcode
+
+        rnd = random.Random(48)
+        parts = ['-', ' ', '\t', 'de', 'DE', 'a', 'A-', 'at-', 'b-', 'Be-', 'CH-', 'F', 'fr', '4', '42477',
+                 'x']
+        pairs = [(country, ''.join(rnd.choice(parts) for _ in range(rnd.randint(0, 5))))
+                 for _ in range(5000) for country in ('DE', 'de', 'AT', 'BE', 'FR', 'CH', 'ABC')]
+        pairs.extend([('DE', None), ('DE', ''), ('DE', '  ')])
+        original = list(pairs)
+        self.assertEqual(georoute.normalize_postcodes(pairs), [cleanup(*pair) for pair in pairs])
+        self.assertEqual(pairs, original)
+        self.assertEqual(georoute.normalize_postcode('DE', ' a-4240 '), ('AT', '4240'))
+
+    def test_threads(self):
+        destinations = [Destination('DE', postcode) for postcode in ('42477', '42897', '53111', '01067')] * 5
+        destinations.append(Destination('DE', 'A-4240'))
+        expected = [vars(self.router.route(destination)) for destination in destinations]
+        pool = ThreadPoolExecutor(4)
+        self.assertEqual([vars(route) for route in pool.map(self.router.route, destinations)], expected)
+        pool.shutdown()
+        self.assertEqual((destinations[-1].country, destinations[-1].postcode), ('DE', 'A-4240'))
+        self.assertEqual(vars(self.router), {'route_data': self.data})
+
     def test_cache(self):
         self.assertDicEq(vars(get_route('LI', '8440')), vars(get_route_without_cache('LI', '8440')))
 
 
+class RouteIndexTest(TestCase):
+
+    def setUp(self):
+        self.router = Router(get_routedata())
+        self.index = get_routeindex()
+
+    def route(self, func, destination):
+        try:
+            return vars(func(destination))
+        except GeorouteException as exception:
+            return (exception.__class__.__name__, str(exception))
+
+    def boundaries(self, count, seed):
+        """Return destinations at and around the bounds of count randomly chosen routes."""
+        rnd = random.Random(seed)
+        cur = get_routedata().db.cursor()
+        cur.execute("""SELECT DestinationCountry, BeginPostCode, EndPostCode FROM routes
+                       WHERE BeginPostCode != ''""")
+        destinations = []
+        for country, begin, end in rnd.sample(cur.fetchall(), count):
+            end = end or begin
+            postcodes = [begin, end, begin + '0', end[:-1], ' %s-%s' % (country, end)]
+            if begin.isdigit() and end.isdigit():
+                postcodes.extend([str(int(begin) - 1).zfill(len(begin)),
+                                  str(int(end) + 1).zfill(len(end))])
+            for postcode in postcodes:
+                destinations.append(Destination(country, postcode, service=rnd.choice(['101', '327', '999'])))
+        return destinations
+
+    def test_same_as_router(self):
+        table = get_decisiontable()
+        routedata = get_routedata()
+        cur = routedata.db.cursor()
+        cur.execute("SELECT DISTINCT DestinationCountry FROM routes")
+        # weighted by the number of routes and the same number for every country
+        samples = (benchmark.sample_destinations(routedata, 1000, seed=32)
+                   + benchmark.sample_destinations(routedata, 1000, seed=32,
+                                                   weights=dict((row[0], 1) for row in cur.fetchall())))
+        self.assertEqual(set(kind for kind, destination in samples), set(['exact', 'range', 'catchall']))
+        destinations = [destination for kind, destination in samples] + self.boundaries(150, 32)
+        self.assertTrue(len(set(destination.country for destination in destinations)) > 150)
+        for destination in destinations:
+            expected = self.route(self.router.route, destination)
+            self.assertEqual(self.route(self.index.route, destination), expected)
+            self.assertEqual(self.route(table.route, destination), expected)
+
+    def test_unknown(self):
+        self.assertRaises(CountryError, self.index.route, Destination('URG', '42477'))
+        self.assertRaises(TranslationError, self.index.route, Destination('DE', None))
+        self.assertRaises(ServiceError, self.index.route, Destination('DE', '0001'))
+
+    def test_destination_unchanged(self):
+        destination = Destination('DE', 'A-4240')
+        self.assertEqual(self.index.route(destination).country, 'AT')
+        self.assertEqual((destination.country, destination.postcode), ('DE', 'A-4240'))
+
+
+class RouteStoreTest(TestCase):
+
+    def test_store(self):
+        rows = [('B16', '0698', '', '12', '37'), ('B16', '0142', '', '', '37'),
+                ('42', '0698', '1', '12', '37')]
+        store = RouteStore(rows)
+        self.assertEqual(len(store), 3)
+        self.assertEqual([store[position] for position in range(3)], rows)
+        self.assertEqual(store.values[0], ['B16', '42'])
+        self.assertEqual(store.codes[0].typecode, 'B')
+        self.assertEqual(len(RouteStore([])), 0)
+
+    def test_route(self):
+        route = get_routeindex().route(Destination('DE', '42477'))
+        self.assertEqual(sorted(vars(route)), sorted(Route.__slots__))
+        self.assertEqual(vars(pickle.loads(pickle.dumps(route))), vars(route))
+        self.assertEqual(vars(pickle.loads(pickle.dumps(route, 0))), vars(route))
+        self.assertRaises(AttributeError, setattr, route, 'city', 'Remscheid')
+
+
+class DecisionTableTest(TestCase):
+
+    def setUp(self):
+        self.index = get_routeindex()
+        self.table = get_decisiontable()
+
+    def route(self, func, destination):
+        try:
+            return vars(func(destination))
+        except GeorouteException as exception:
+            return (exception.__class__.__name__, str(exception))
+
+    def test_same_as_index(self):
+        cur = get_routedata().db.cursor()
+        cur.execute("""SELECT DestinationCountry, BeginPostCode, EndPostCode FROM routes
+                       WHERE id % 211 = 1""")
+        for country, begin, end in cur.fetchall():
+            for postcode in (begin, end, begin + '0', end[:-1], ' %s-%s' % (country, end), ''):
+                for service in ('101', '327', '999'):
+                    destination = Destination(country, postcode, service=service)
+                    self.assertEqual(self.route(self.index.route, destination),
+                                     self.route(self.table.route, destination))
+
+    def test_unknown(self):
+        self.assertRaises(CountryError, self.table.route, Destination('URG', '42477'))
+        self.assertRaises(TranslationError, self.table.route, Destination('DE', None))
+        self.assertRaises(ServiceError, self.table.route, Destination('DE', '0001'))
+
+    def test_version_stamp(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, 'decisions')
+            shutil.copy(self.table.filename, filename)
+            routedata = RouteData()
+            table = DecisionTable(routedata, filename=filename)
+            self.assertEqual(vars(table.route(Destination('DE', '42477'))),
+                             vars(self.table.route(Destination('DE', '42477'))))
+            routedata.version = '19990101'
+            self.assertFalse(table.load())
+            open(filename, 'wb').close()
+            self.assertFalse(table.load())
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_shared(self):
+        # the tables are read from the mapped file, not copied into each process
+        self.assertTrue(isinstance(self.table.buffer, mmap.mmap))
+        self.assertEqual(self.table.buffer[:4], DecisionTable.MAGIC)
+
+
+class WarmupTest(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache = RouteCache(os.path.join(self.tempdir, 'cache.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_enumerate_postcodes(self):
+        postcodes = warmup.enumerate_postcodes(get_routedata(), ['AX'])['AX']
+        self.assertEqual(postcodes[:5], ['22100', '22101', '22110', '22120', '22130'])
+        self.assertEqual(len(postcodes), len(set(postcodes)))
+
+    def test_warmup(self):
+        result = warmup.warmup(['AX'], ['101', '327'], processes=2, cache=self.cache)
+        self.assertEqual(result['destinations'], 2 * 37)
+        self.assertEqual(result['stored'], result['destinations'] - sum(result['errors'].values()))
+        self.assertTrue(0 < result['coverage'] <= 1)
+        route = self.cache.get('AX', '22101', None, '101')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 0))
+        self.assertEqual(vars(route), vars(get_route_without_cache('AX', '22101')))
+
+    def test_routingdepot(self):
+        old_cache = georoute.route_cache
+        georoute.route_cache = self.cache
+        try:
+            warmup.warmup(['AX'], ['101'], processes=1, routingdepot='0307')
+            route = get_route('AX', '22101', routingdepot='0307')
+            self.assertEqual((self.cache.hits, self.cache.misses), (1, 0))
+            self.assertEqual(vars(route), vars(get_route_without_cache('AX', '22101', routingdepot='0307')))
+            get_route('AX', '22101')
+            self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        finally:
+            georoute.route_cache = old_cache
+
+
+class MetricsTest(TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.disable()
+        metrics.reset()
+
+    def test_disabled(self):
+        Router(get_routedata()).route(Destination('DE', '42477'))
+        self.assertEqual(metrics.snapshot(), dict(timings={}, counters={}))
+
+    def test_router(self):
+        metrics.enable()
+        router = Router(get_routedata())
+        router.route(Destination('DE', '42477'))
+        self.assertRaises(ServiceError, router.route, Destination('DE', '0001'))
+        snapshot = metrics.snapshot()
+        for stage in ('cleanup', 'country', 'postcode', 'service', 'depot'):
+            self.assertTrue(snapshot['timings']['route.' + stage]['count'] >= 1)
+        self.assertEqual(snapshot['timings']['route.total']['count'], 1)
+        self.assertEqual(sum([count for name, count in snapshot['counters'].items()
+                              if name.startswith('postcode.')]), 2)
+        self.assertEqual(sum([count for name, count in snapshot['counters'].items()
+                              if name.startswith('service.')]), 1)
+
+    def test_cache(self):
+        metrics.enable()
+        tempdir = tempfile.mkdtemp()
+        try:
+            cache = RouteCache(os.path.join(tempdir, 'cache.db'))
+            cache.get('DE', '42477', None, '101')
+            cache.get('DE', '42477', None, '101')
+            RouteCache(cache.filename).get('DE', '42477', None, '101')
+        finally:
+            shutil.rmtree(tempdir)
+        snapshot = metrics.snapshot()
+        self.assertEqual(dict((name, count) for name, count in snapshot['counters'].items()
+                              if name.startswith('cache.')),
+                         {'cache.miss': 1, 'cache.hit.memory': 1, 'cache.hit.db': 1})
+        self.assertEqual(snapshot['timings']['cache.lookup']['count'], 3)
+
+
+class BenchmarkTest(TestCase):
+
+    def test_sample_destinations(self):
+        sample = benchmark.sample_destinations(get_routedata(), 300, seed=43, weights={'DE': 2, 'AT': 1})
+        self.assertEqual(len(sample), 300)
+        self.assertEqual(set([kind for kind, destination in sample]), set(['exact', 'range', 'catchall']))
+        self.assertEqual(set([destination.country for kind, destination in sample]), set(['DE', 'AT']))
+        self.assertEqual([vars(destination) for kind, destination in sample],
+                         [vars(destination) for kind, destination
+                          in benchmark.sample_destinations(get_routedata(), 300, seed=43,
+                                                           weights={'DE': 2, 'AT': 1})])
+
+    def test_run(self):
+        results = benchmark.run(count=40, cold=False, limits={'get_route_without_cache': 5})
+        self.assertEqual(sorted(results), ['decisiontable', 'get_route_without_cache', 'routeindex'])
+        self.assertEqual(results['get_route_without_cache']['samples'], 5)
+        self.assertEqual(results['routeindex']['errors'], results['decisiontable']['errors'])
+        for result in results.values():
+            self.assertTrue(0 < result['p50'] <= result['p99'])
+            self.assertTrue(result['throughput'] > 0)
+
+
+class RouteManyTest(TestCase):
+
+    def test_route_many(self):
+        routes = route_many([('DE', '42897'), Destination('DE', '42897', 'Remscheid'), ('URG', '42477'),
+                             ('DE', '53111', 'Bonn', '101'), ('DE', '0001'), ('DE', '42897')])
+        self.assertEqual(len(routes), 6)
+        self.assertEqual(vars(routes[0]), vars(get_route_without_cache('DE', '42897')))
+        self.assertEqual(vars(routes[1]), vars(routes[0]))
+        self.assertTrue(isinstance(routes[2], CountryError))
+        self.assertEqual(vars(routes[3]), vars(get_route_without_cache('DE', '53111', 'Bonn', '101')))
+        self.assertTrue(isinstance(routes[4], ServiceError))
+        self.assertTrue(routes[5] is routes[0])
+        self.assertEqual(route_many([]), [])
+
+    def test_normalized_keys(self):
+        routes = route_many([('DE', '42897'), ('de', '42897'), ('DE', '42897', None, '101'),
+                             Destination('DE', 'DE-42897', 'Remscheid'), ('DE', ' 42 897'),
+                             ('DE', 'A-4240'), ('AT', '4240', None), ('DE', '42897', None, '327')])
+        self.assertEqual(vars(routes[0]), vars(get_route_without_cache('DE', '42897')))
+        self.assertTrue(all(route is routes[0] for route in routes[1:5]))
+        self.assertTrue(routes[6] is routes[5])
+        self.assertEqual(vars(routes[5]), vars(get_route_without_cache('AT', '4240')))
+        self.assertFalse(routes[7] is routes[0])
+
+
 class HighLevelTest(TestCase):
 
     def test_get_route(self):
@@ -480,6 +1072,73 @@ class HighLevelTest(TestCase):
     def test_cache(self):
         self.assertEqual(vars(get_route('LI', '8440')), vars(get_route_without_cache('LI', '8440')))
 
+
+class RouteCacheTest(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_cache(self):
+        cache = RouteCache(self.filename, maxsize=2)
+        route = cache.get('DE', '42897', None, '101')
+        self.assertEqual(vars(route), vars(get_route_without_cache('DE', '42897')))
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        self.assertEqual(vars(cache.get('DE', '42897', None, '101')), vars(route))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # city is part of the key
+        cache.get('DE', '42897', 'Remscheid', '101')
+        cache.get('DE', '53111', None, '101')
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+        self.assertEqual(len(cache.lru), 2)
+        # shared by processes through the database
+        other = RouteCache(self.filename)
+        self.assertEqual(vars(other.get('DE', '42897', None, '101')), vars(route))
+        self.assertEqual((other.hits, other.misses), (1, 0))
+
+    def test_routingdepot(self):
+        cache = RouteCache(self.filename)
+        # routed from 0307, but not from 0142
+        self.assertRaises(georoute.RoutingDepotError, get_route_without_cache, 'FR', '88809')
+        expected = vars(Router(get_routedata('0307')).route(Destination('FR', '88809', None, '101')))
+        self.assertEqual(vars(cache.get('FR', '88809', None, '101', routingdepot='0307')), expected)
+        self.assertEqual(vars(cache.get('FR', '88809', None, '101', routingdepot='0307')), expected)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(vars(RouteCache(self.filename).get('FR', '88809', None, '101', '0307')), expected)
+        self.assertRaises(georoute.RoutingDepotError, cache.get, 'FR', '88809', None, '101')
+
+    def test_none_and_empty(self):
+        cache = RouteCache(self.filename)
+        self.assertRaises(ServiceError, get_route_without_cache, 'IE', '', 'Dublin')
+        route = cache.get('IE', None, 'Dublin', '101')
+        self.assertEqual(vars(route), vars(get_route_without_cache('IE', None, 'Dublin')))
+        self.assertRaises(ServiceError, cache.get, 'IE', '', 'Dublin', '101')
+        self.assertRaises(ServiceError, RouteCache(self.filename).get, 'IE', '', 'Dublin', '101')
+        self.assertEqual(vars(RouteCache(self.filename).get('IE', None, 'Dublin', '101')), vars(route))
+
+    def test_evict(self):
+        cache = RouteCache(self.filename)
+        cache.get('DE', '42897', None, '101')
+        cache.db.execute("UPDATE route_cache SET version='19990101'")
+        cache.version = '19990101'
+        cache.get('DE', '53111', None, '101')
+        self.assertEqual(cache.db.execute("SELECT COUNT(*) FROM route_cache").fetchone()[0], 1)
+        cache.get('DE', '42897', None, '101')
+        self.assertEqual((cache.hits, cache.misses), (0, 3))
+
+    def test_evict_newer(self):
+        cache = RouteCache(self.filename)
+        cache.get('DE', '42897', None, '101')
+        # another process already uses a newer version
+        cache.db.execute("UPDATE route_cache SET version='99990101'")
+        cache.version = '99990101'
+        cache.get('DE', '53111', None, '101')
+        versions = cache.db.execute("SELECT version FROM route_cache ORDER BY version").fetchall()
+        self.assertEqual(versions, [(georoute.read_version(), ), ('99990101', )])
+
 if __name__ == '__main__':
     start = time.time()
     router = Router(RouteData())
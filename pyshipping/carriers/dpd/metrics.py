@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+metrics.py - timing histograms and counters for the DPD routing code.
+
+Collection is off by default. When it is off, instrumented code only checks `metrics.enabled`.
+
+    from pyshipping.carriers.dpd.georoute import metrics, get_route
+    metrics.enable()
+    get_route('DE', '42477')
+    metrics.snapshot()['timings']['route.total']['p99']
+
+Copyright 2026 HUDORA GmbH. Published under a BSD License.
+"""
+
+import threading
+import time
+import unittest
+
+
+clock = time.perf_counter
+
+
+class Histogram(object):
+    """Histogram of durations in seconds.
+
+    Buckets grow by a factor of two, starting at one microsecond. Percentiles are reported as the
+    upper bound of the bucket they fall into.
+    """
+
+    BOUNDS = tuple([0.000001 * 2 ** i for i in range(28)])
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        """Record one duration."""
+        i = 0
+        bounds = self.BOUNDS
+        while i < len(bounds) and seconds > bounds[i]:
+            i += 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        """Return the upper bound of the bucket containing the given percentile, None if empty."""
+        if not self.count:
+            return None
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= wanted:
+                return self.BOUNDS[i] if i < len(self.BOUNDS) else self.max
+        return self.max
+
+    def as_dict(self):
+        """Return count, total, mean, max, p50, p90, p99 and the non-empty buckets."""
+        return dict(count=self.count, total=self.total, max=self.max,
+                    mean=self.total / self.count if self.count else None,
+                    p50=self.percentile(50), p90=self.percentile(90), p99=self.percentile(99),
+                    buckets=dict((self.BOUNDS[i] if i < len(self.BOUNDS) else None, count)
+                                 for i, count in enumerate(self.buckets) if count))
+
+
+class Metrics(object):
+    """Collects timing histograms per stage and named counters.
+
+    Instrumented code checks `enabled` before calling record(), lap() or count(), so disabled metrics
+    cost a single attribute lookup.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        """Drop all collected data."""
+        with self.lock:
+            self.timings = {}
+            self.counters = {}
+
+    def record(self, stage, seconds):
+        """Add a duration to the histogram of stage."""
+        with self.lock:
+            histogram = self.timings.get(stage)
+            if histogram is None:
+                histogram = self.timings[stage] = Histogram()
+            histogram.add(seconds)
+
+    def lap(self, stage, start):
+        """Record the time since start for stage and return the current clock() value."""
+        now = clock()
+        self.record(stage, now - start)
+        return now
+
+    def count(self, name, increment=1):
+        """Increment counter name."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + increment
+
+    def snapshot(self):
+        """Return the collected data as a dict with `timings` and `counters`."""
+        with self.lock:
+            timings = dict((stage, histogram.as_dict()) for stage, histogram in self.timings.items())
+            return dict(timings=timings, counters=dict(self.counters))
+
+
+metrics = Metrics()
+
+
+class MetricsTests(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.percentile(50), None)
+        for seconds in [0.0000005] * 98 + [0.003, 0.5]:
+            histogram.add(seconds)
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.percentile(50), 0.000001)
+        self.assertTrue(0.003 <= histogram.percentile(99) < 0.006)
+        self.assertEqual(histogram.as_dict()['max'], 0.5)
+
+    def test_metrics(self):
+        collected = Metrics()
+        start = collected.lap('stage', clock())
+        self.assertTrue(start <= clock())
+        collected.count('hit')
+        collected.count('hit', 2)
+        snapshot = collected.snapshot()
+        self.assertEqual(snapshot['counters'], {'hit': 3})
+        self.assertEqual(snapshot['timings']['stage']['count'], 1)
+        collected.reset()
+        self.assertEqual(collected.snapshot(), dict(timings={}, counters={}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+warmup.py - fill the DPD routing cache after a routing table update.
+
+Enumerates the postcodes of all routes for the selected destination countries and services, routes
+them in worker processes and stores the results in the cache used by georoute.get_route().
+
+    python -m pyshipping.carriers.dpd.warmup -c DE,AT -s 101,327 -j 4
+
+Copyright 2026 HUDORA GmbH. Published under a BSD License.
+"""
+
+import multiprocessing
+import optparse
+import time
+from pyshipping.carriers.dpd import georoute
+
+
+def enumerate_postcodes(routedata, countries, maxrange=1000):
+    """Return a dict mapping each country to the sorted postcodes of its routes.
+
+    Numeric ranges with up to maxrange postcodes are enumerated completely, for all other routes
+    BeginPostCode and EndPostCode are used. Catch all routes have no postcodes to enumerate.
+    """
+    cur = routedata.db.cursor()
+    postcodes = {}
+    for country in countries:
+        found = set()
+        cur.execute("SELECT BeginPostCode, EndPostCode FROM routes WHERE DestinationCountry=?", (country, ))
+        for begin, end in cur.fetchall():
+            if not begin:
+                continue
+            if (begin.isdigit() and end.isdigit() and len(begin) == len(end)
+                and 0 <= int(end) - int(begin) < maxrange):
+                found.update([str(postcode).zfill(len(begin))
+                              for postcode in range(int(begin), int(end) + 1)])
+            else:
+                found.add(begin)
+                if end:
+                    found.add(end)
+        postcodes[country] = sorted(found)
+    return postcodes
+
+
+def _route_chunk(args):
+    """Route a list of (country, postcode, servicecode) in a worker process.
+
+    Returns a list of (key, Route) pairs for RouteCache.put_many() and a dict counting the errors."""
+    routingdepot, chunk = args
+    table = georoute.get_decisiontable(routingdepot)
+    routes = []
+    errors = {}
+    for country, postcode, servicecode in chunk:
+        try:
+            route = table.route(georoute.Destination(country, postcode, None, servicecode))
+        except georoute.GeorouteException as exception:
+            name = exception.__class__.__name__
+            errors[name] = errors.get(name, 0) + 1
+        else:
+            routes.append(((country, postcode, None, servicecode), route))
+    return routes, errors
+
+
+def warmup(countries, services=('101', ), processes=None, routingdepot='0142', maxrange=1000,
+           chunksize=5000, cache=None):
+    """Route all postcodes of countries for services and store the results in cache.
+
+    cache defaults to the cache used by get_route(). Returns a dict with the number of destinations
+    routed, the number of routes stored, the errors by exception name, the coverage - the fraction of
+    destinations which could be routed - and the elapsed time in seconds.
+    """
+    start = time.time()
+    if cache is None:
+        cache = georoute.route_cache
+    # build the tables before forking, so the workers can share them
+    georoute.get_decisiontable(routingdepot)
+    postcodes = enumerate_postcodes(georoute.get_routedata(routingdepot), countries, maxrange)
+    destinations = [(country, postcode, servicecode) for country in countries
+                    for servicecode in services for postcode in postcodes[country]]
+    chunks = [(routingdepot, destinations[i:i + chunksize]) for i in range(0, len(destinations), chunksize)]
+
+    stored = 0
+    errors = {}
+    pool = multiprocessing.Pool(processes)
+    try:
+        for routes, chunkerrors in pool.imap_unordered(_route_chunk, chunks):
+            stored += cache.put_many(routes, routingdepot)
+            for name, count in chunkerrors.items():
+                errors[name] = errors.get(name, 0) + count
+    finally:
+        pool.close()
+        pool.join()
+
+    failed = sum(errors.values())
+    return dict(destinations=len(destinations), stored=stored, errors=errors,
+                coverage=(float(len(destinations) - failed) / len(destinations)) if destinations else 1.0,
+                elapsed=time.time() - start)
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-c', '--countries', default='DE', help="comma separated destination countries")
+    parser.add_option('-s', '--services', default='101', help="comma separated service codes")
+    parser.add_option('-d', '--routingdepot', default='0142', help="depot the parcels are sent from")
+    parser.add_option('-j', '--processes', type='int', help="number of worker processes")
+    parser.add_option('-m', '--maxrange', type='int', default=1000,
+                      help="enumerate numeric postcode ranges up to this size, larger ones by their bounds")
+    options, args = parser.parse_args()
+    result = warmup(options.countries.upper().split(','), options.services.split(','), options.processes,
+                    options.routingdepot, options.maxrange)
+    print("%(destinations)d destinations, %(stored)d routes cached, coverage %(coverage).1f%%, "
+          "%(elapsed).1fs" % dict(result, coverage=result['coverage'] * 100))
+    for name, count in sorted(result['errors'].items()):
+        print("%s: %d" % (name, count))
+
+
+if __name__ == '__main__':
+    main()
@@ -232,7 +232,7 @@ def buendelung(kartons, maxweight=31000, maxgurtmass=3000):
     return buendelcounter, gebuendelt, rest
 
 
-def pack_in_bins(kartons, versandkarton):
+def pack_in_bins(kartons, versandkarton, maxweight=None):
     """Implements Bin-Packing.
 
     You provide it with a bin size and a list of Package Objects to be bined. Returns a list of lists
@@ -241,6 +241,13 @@ def pack_in_bins(kartons, versandkarton):
     >>> pack_in_bins([Package('135x200x250'), Package('170x380x390'), Package('485x280x590'), Package('254x171x368'), Package('201x172x349'), Package('254x171x368')], \
                      Package('600x400x400'))
     ([[<Package 250x200x135>, <Package 349x201x172>, <Package 368x254x171>], [<Package 368x254x171>, <Package 390x380x170>]], [<Package 590x485x280>])
+
+    If maxweight is given no bin gets heavier than that. Packages heavier than maxweight are returned
+    as too big.
+
+    >>> pack_in_bins([Package('100x100x100', 12000), Package('100x100x100', 12000), Package('100x100x100', 12000), Package('100x100x100', 40000)], \
+                     Package('600x400x400'), maxweight=31000)
+    ([[<Package 100x100x100 12000>, <Package 100x100x100 12000>], [<Package 100x100x100 12000>]], [<Package 100x100x100 40000>])
     """
 
     import pyshipping.binpack
@@ -249,10 +256,13 @@ def pack_in_bins(kartons, versandkarton):
         if box not in versandkarton:
             # passt eh nicht
             toobig.append(box)
+        elif maxweight is not None and (box.weight or 0) > maxweight:
+            # zu schwer
+            toobig.append(box)
         else:
             packagelist.append(box)
     if packagelist:
-        bins, rest = pyshipping.binpack.binpack(packagelist, versandkarton)
+        bins, rest = pyshipping.binpack.binpack(packagelist, versandkarton, maxweight=maxweight)
     return bins, toobig + rest
 
 
@@ -295,6 +305,20 @@ class PackageTests(unittest.TestCase):
         """Test multiplication."""
         self.assertEqual(Package((200, 200, 200)), Package((100, 200, 200)) * 2)
 
+    def test_pack_in_bins_maxweight(self):
+        """Test that bins never exceed the weight limit."""
+        kartons = [Package('300x200x200', 7000) for _ in range(10)] + [Package('200x200x100', 1000)] * 4
+        bins, rest = pack_in_bins(kartons, Package('600x400x400'))
+        self.assertEqual((len(bins), rest), (2, []))
+        bins, rest = pack_in_bins(kartons, Package('600x400x400'), maxweight=31000)
+        self.assertEqual((len(bins), rest), (3, []))
+        for packages in bins:
+            self.assertTrue(sum([package.weight for package in packages]) <= 31000)
+        bins, rest = pack_in_bins(kartons, Package('600x400x400'), maxweight=20000)
+        self.assertEqual((len(bins), rest), (5, []))
+        for packages in bins:
+            self.assertTrue(sum([package.weight for package in packages]) <= 20000)
+
     def test_sort(self):
         """Test multiplication."""
         data = [Package((1600, 490, 480)), Package((1600, 470, 480)), Package((1600, 480, 480))]
@@ -10,6 +10,132 @@ Copyright (c) 2007 HUDORA GmbH. All rights reserved.
 
 import unittest
 import math
+import functools
+from pyshipping.package import Package, pack_in_bins
+
+
+# Standard-Versandkarton, in den angebrochene Exportkartons gepackt werden.
+VERSANDKARTON = '600x400x400'
+
+
+def expand_gewichte(runs):
+    """Expands run-length encoded (gewicht, anzahl) tuples into a flat list of weights.
+
+    >>> expand_gewichte([(500, 3), (120, 1)])
+    [500, 500, 500, 120]
+    """
+    ret = []
+    for gewicht, anzahl in runs:
+        ret.extend([gewicht] * anzahl)
+    return ret
+
+
+@functools.lru_cache(maxsize=4096)
+def _anbruch_pakete(versandkarton, maxgewicht, anbrueche):
+    """Packt die einzelnen Produkte aus angebrochenen Exportkartons in Versandkartons.
+
+    `anbrueche` ist ein sortiertes Tupel aus ((abmessungen, gewicht), anzahl) Paaren und damit der
+    Schlüssel für das Memoizing - die gleiche Mischung wird nur einmal gepackt. Gibt die Anzahl der
+    Pakete zurück.
+    """
+    packages = []
+    for (abmessungen, gewicht), anzahl in anbrueche:
+        packages.extend([Package(abmessungen, gewicht) for _ in range(anzahl)])
+    bins, rest = pack_in_bins(packages, Package(versandkarton), maxweight=maxgewicht)
+    # Produkte die nicht in den Versandkarton passen werden einzeln verschickt
+    return len(bins) + len(rest)
+
+
+def pakete_schaetzen(itemlist, versandkarton=VERSANDKARTON, maxgewicht=31500):
+    """Schätzt die Anzahl der Pakete, die für die Items verschickt werden.
+
+    Volle Exportkartons werden unverändert verschickt. Die Produkte aus angebrochenen Exportkartons
+    aller Items werden gemeinsam mit binpack in Versandkartons gepackt, die höchstens `maxgewicht` Gramm
+    wiegen. Dazu muss jedes angebrochene Item die Attribute `einzelabmessungen` und `einzelgewicht` haben.
+
+    >>> item = AbstractItem()
+    >>> item.menge, item.produkte_pro_exportkarton, item.einzelabmessungen = 7, 3, (200, 200, 100)
+    >>> item.einzelgewicht = 800
+    >>> pakete_schaetzen([item, item])
+    5
+    """
+    volle = 0
+    anbrueche = {}
+    for item in itemlist:
+        volle += int(item.menge // item.produkte_pro_exportkarton)
+        rest = int(item.menge % item.produkte_pro_exportkarton)
+        if rest:
+            key = (Package(item.einzelabmessungen).size, item.einzelgewicht)
+            anbrueche[key] = anbrueche.get(key, 0) + rest
+    if not anbrueche:
+        return volle
+    return volle + _anbruch_pakete(Package(versandkarton).size, maxgewicht, tuple(sorted(anbrueche.items())))
+
+
+def kep_aufteilen(gewichte, max_kartons=10, max_kartongewicht=31500, max_sendungsgewicht=None):
+    """Teilt Kartons auf möglichst wenige Sendungen auf, die mit einem Paketdienst verschickt werden können.
+
+    `gewichte` sind die Kartongewichte in Gramm als (gewicht, anzahl) Tupel, wie sie
+    export_karton_gewichte_rle liefert. Jede Teilsendung hat höchstens `max_kartons` Kartons und, falls
+    angegeben, höchstens `max_sendungsgewicht` Gesamtgewicht. Kartons schwerer als `max_kartongewicht`
+    können nicht per KEP verschickt werden.
+
+    Das Verfahren ist First Fit Decreasing auf Gewicht und Kartonanzahl. Da es auf den Läufen gleich
+    schwerer Kartons arbeitet, hängt die Laufzeit nicht von der Anzahl der Kartons ab.
+
+    Gibt eine Liste der Teilsendungen (jeweils als Liste von (gewicht, anzahl) Tupeln) und eine Liste
+    der zu schweren Kartons zurück.
+
+    >>> kep_aufteilen([(12000, 14), (40000, 1), (3000, 3)], max_sendungsgewicht=100000)
+    ([[(12000, 8), (3000, 1)], [(12000, 6), (3000, 2)]], [(40000, 1)])
+    """
+    limit = max_kartongewicht
+    if max_sendungsgewicht is not None:
+        limit = min(limit, max_sendungsgewicht)
+    laeufe = []
+    zu_schwer = []
+    for gewicht, anzahl in sorted(gewichte, key=lambda lauf: lauf[0], reverse=True):
+        if anzahl <= 0:
+            continue
+        if gewicht > limit:
+            zu_schwer.append((gewicht, anzahl))
+        else:
+            laeufe.append((gewicht, anzahl))
+    # Sendungen, die nicht einmal mehr den leichtesten Karton aufnehmen können, werden geschlossen
+    leichtester = laeufe[-1][0] if laeufe else 0
+
+    sendungen = []  # [kartons frei, gewicht frei, läufe]
+    offen = []      # Sendungen in die noch Kartons passen
+    for gewicht, anzahl in laeufe:
+        for sendung in offen:
+            passen = min(anzahl, sendung[0])
+            if max_sendungsgewicht is not None and gewicht > 0:
+                passen = min(passen, int(sendung[1] // gewicht))
+            if passen > 0:
+                sendung[0] -= passen
+                if max_sendungsgewicht is not None:
+                    sendung[1] -= passen * gewicht
+                sendung[2].append((gewicht, passen))
+                anzahl -= passen
+                if not anzahl:
+                    break
+        offen = [sendung for sendung in offen
+                 if sendung[0] and (sendung[1] is None or sendung[1] >= leichtester)]
+        while anzahl:
+            passen = min(anzahl, max_kartons)
+            if max_sendungsgewicht is not None and gewicht > 0:
+                passen = min(passen, int(max_sendungsgewicht // gewicht))
+            frei = max_sendungsgewicht - passen * gewicht if max_sendungsgewicht is not None else None
+            sendungen.append([max_kartons - passen, frei, [(gewicht, passen)]])
+            if max_kartons - passen:
+                offen.append(sendungen[-1])
+            anzahl -= passen
+    return [sendung[2] for sendung in sendungen], zu_schwer
+
+
+def kep_aufteilungen(lieferungen, **kwargs):
+    """Teilt eine Menge von Lieferungen mit kep_aufteilen() auf. Gibt eine Liste der Ergebnisse zurück."""
+    return [kep_aufteilen(lieferung.export_karton_gewichte_rle, **kwargs) for lieferung in lieferungen]
 
 
 class AbstractPackstueck(object):
@@ -28,6 +154,7 @@ class AbstractItem(object):
         #self.produkte_pro_exportkarton = None
         #self.einzelvolumen = None
         #self.einzelgewicht = None
+        #self.einzelabmessungen = None
         self.menge = None
 
     def __unicode__(self):
@@ -83,16 +210,25 @@ class AbstractItem(object):
     @property
     def export_karton_gewichte(self):
         """Returns the weights of the estimated number of packages which will be shipped in gramms."""
+        return expand_gewichte(self.export_karton_gewichte_rle)
+
+    @property
+    def export_karton_gewichte_rle(self):
+        """Returns the weights of the estimated packages as run-length encoded (gewicht, anzahl) tuples.
+
+        All packages but the last one are full export packages, so this is computed in closed form and has
+        at most two entries regardless of menge."""
         menge = self.menge
-        ret = []
-        while menge:
-            if menge > self.produkte_pro_exportkarton:
-                ret.append(self.gewicht_pro_exportkarton)
-                menge -= self.produkte_pro_exportkarton
-            else:
-                ret.append(menge * self.einzelgewicht)
-                menge = 0
-        return ret
+        if not menge:
+            return []
+        if menge <= self.produkte_pro_exportkarton:
+            return [(menge * self.einzelgewicht, 1)]
+        # every package but the last one is full, the last one holds 1 to produkte_pro_exportkarton units
+        volle = (menge - 1) // self.produkte_pro_exportkarton
+        rest = menge - volle * self.produkte_pro_exportkarton
+        if rest * self.einzelgewicht == self.gewicht_pro_exportkarton:
+            return [(self.gewicht_pro_exportkarton, volle + 1)]
+        return [(self.gewicht_pro_exportkarton, volle), (rest * self.einzelgewicht, 1)]
 
     @property
     def packstuecke(self):
@@ -192,11 +328,36 @@ class AbstractLieferung(object):
     @property
     def export_karton_gewichte(self):
         """Returns the weights of the estimated number of packages which will be shipped in gramms."""
+        return expand_gewichte(self.export_karton_gewichte_rle)
+
+    @property
+    def export_karton_gewichte_rle(self):
+        """Returns the weights of the estimated packages as run-length encoded (gewicht, anzahl) tuples.
+
+        Adjacent runs of the same weight are merged, the order matches export_karton_gewichte."""
         ret = []
         for box in self.itemlist:
-            ret.extend(box.export_karton_gewichte)
+            for gewicht, anzahl in box.export_karton_gewichte_rle:
+                if ret and ret[-1][0] == gewicht:
+                    ret[-1] = (gewicht, ret[-1][1] + anzahl)
+                else:
+                    ret.append((gewicht, anzahl))
         return ret
 
+    @property
+    def pakete(self):
+        """Returns the estimated number of parcels when partial cartons are packed together.
+
+        See pakete_schaetzen() for details. This is an integer."""
+        return pakete_schaetzen(self.itemlist)
+
+    @property
+    def kep_aufteilung(self):
+        """Returns the cartons split into the fewest shipments which could be sent by a parcel service.
+
+        See kep_aufteilen() for the format."""
+        return kep_aufteilen(self.export_karton_gewichte_rle)
+
     @property
     def kep(self):
         """Entscheidet, ob die Sendung mit einem Paketdienstleister verchickt werden kann."""
@@ -248,5 +409,106 @@ class simpleTests(unittest.TestCase):
         # print alieferung.transportweg
         # print alieferung.fix
 
+    def test_export_karton_gewichte(self):
+        """The closed form run-length weights have to match a carton by carton calculation."""
+        def kartonweise(menge, item):
+            ret = []
+            while menge:
+                if menge > item.produkte_pro_exportkarton:
+                    ret.append(item.gewicht_pro_exportkarton)
+                    menge -= item.produkte_pro_exportkarton
+                else:
+                    ret.append(menge * item.einzelgewicht)
+                    menge = 0
+            return ret
+
+        aitem = AbstractItem()
+        aitem.einzelgewicht = 300
+        aitem.produkte_pro_exportkarton = 4
+        aitem.gewicht_pro_exportkarton = 1250
+        for menge in range(0, 30):
+            aitem.menge = menge
+            self.assertEqual(aitem.export_karton_gewichte, kartonweise(menge, aitem))
+        aitem.menge = 500000
+        self.assertEqual(aitem.export_karton_gewichte_rle, [(1250, 124999), (1200, 1)])
+
+        aitem2 = AbstractItem()
+        aitem2.menge = 5
+        aitem2.einzelgewicht = 1250
+        aitem2.produkte_pro_exportkarton = 1
+        aitem2.gewicht_pro_exportkarton = 1250
+        alieferung = AbstractLieferung()
+        alieferung.itemlist = [aitem, aitem2]
+        self.assertEqual(alieferung.export_karton_gewichte_rle, [(1250, 124999), (1200, 1), (1250, 5)])
+        aitem.menge = 9
+        self.assertEqual(alieferung.export_karton_gewichte_rle, [(1250, 2), (300, 1), (1250, 5)])
+        self.assertEqual(alieferung.export_karton_gewichte, [1250, 1250, 300] + [1250] * 5)
+        self.assertEqual(aitem2.export_karton_gewichte_rle, [(1250, 5)])
+
+    def test_pakete(self):
+        """Partial cartons of several items share parcels."""
+        aitem = AbstractItem()
+        aitem.menge = 13
+        aitem.produkte_pro_exportkarton = 6
+        aitem.einzelabmessungen = '300x200x100'
+        aitem2 = AbstractItem()
+        aitem2.menge = 4
+        aitem2.produkte_pro_exportkarton = 10
+        aitem2.einzelabmessungen = '200x200x100'
+        aitem.einzelgewicht = aitem2.einzelgewicht = 1500
+        alieferung = AbstractLieferung()
+        alieferung.itemlist = [aitem, aitem2]
+        self.assertEqual(alieferung.packstuecke, 4)
+        self.assertEqual(alieferung.pakete, 3)
+        # the parcel weight limit is respected
+        aitem2.einzelgewicht = 9000
+        self.assertEqual(alieferung.pakete, 4)
+        aitem2.einzelgewicht = 1500
+        # products too big for the Versandkarton are shipped one by one
+        aitem2.einzelabmessungen = '700x200x100'
+        self.assertEqual(alieferung.pakete, 7)
+        self.assertEqual(pakete_schaetzen(alieferung.itemlist, versandkarton='800x400x400'), 3)
+        # without partial cartons no packing is needed
+        aitem.menge = 12
+        aitem2.menge = 10
+        self.assertEqual(alieferung.pakete, 3)
+
+    def test_kep_aufteilung(self):
+        """Splitting into KEP compliant shipments."""
+        aitem = AbstractItem()
+        aitem.menge = 25
+        aitem.einzelgewicht = 2000
+        aitem.produkte_pro_exportkarton = 1
+        aitem.gewicht_pro_exportkarton = 2000
+        alieferung = AbstractLieferung()
+        alieferung.itemlist = [aitem]
+        self.assertEqual(alieferung.kep, False)
+        sendungen, zu_schwer = alieferung.kep_aufteilung
+        self.assertEqual(sendungen, [[(2000, 10)], [(2000, 10)], [(2000, 5)]])
+        self.assertEqual(zu_schwer, [])
+        for sendung in sendungen:
+            teil = AbstractLieferung()
+            teil.itemlist = [AbstractItem()]
+            teil.itemlist[0].menge = sum(anzahl for gewicht, anzahl in sendung)
+            teil.itemlist[0].einzelgewicht = 2000
+            teil.itemlist[0].produkte_pro_exportkarton = 1
+            teil.itemlist[0].gewicht_pro_exportkarton = 2000
+            self.assertEqual(teil.kep, True)
+
+        # with a weight limit per shipment the lighter cartons fill up the gaps
+        gewichte = [(20000, 3), (15000, 4), (9000, 5), (1000, 12)]
+        sendungen, zu_schwer = kep_aufteilen(gewichte, max_sendungsgewicht=31500)
+        self.assertEqual(len(sendungen), 6)
+        self.assertEqual(zu_schwer, [])
+        for sendung in sendungen:
+            self.assertTrue(sum(anzahl for gewicht, anzahl in sendung) <= 10)
+            self.assertTrue(sum(gewicht * anzahl for gewicht, anzahl in sendung) <= 31500)
+        self.assertEqual(sorted(gewichte), sorted((g, sum(a for s in sendungen for (g2, a) in s if g2 == g))
+                                                  for g, _ in gewichte))
+        self.assertEqual(kep_aufteilen([(32000, 2)]), ([], [(32000, 2)]))
+        self.assertEqual(kep_aufteilungen([alieferung, AbstractLieferung()])[1], ([], []))
+
 if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
     unittest.main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+shipment_columnar.py - spaltenweise Kennzahlen für viele Lieferungen.
+
+Die Properties von AbstractLieferung berechnen jede Kennzahl einzeln und laufen dabei jedesmal über alle
+Items. Für die Tourenplanung mit vielen tausend Lieferungen ist das zu langsam. Hier werden die
+Item-Attribute einmal in typisierte Arrays geladen und alle Kennzahlen in wenigen Durchläufen pro Spalte
+berechnet - mit den gleichen Ergebnissen wie die Objekt-API in shipment.py.
+
+Copyright (c) 2026 HUDORA GmbH. All rights reserved.
+"""
+
+import math
+import operator
+import unittest
+from array import array
+from itertools import starmap
+
+
+ITEM_ATTRIBUTES = ('menge', 'einzelgewicht', 'einzelvolumen', 'palettenfaktor', 'produkte_pro_exportkarton',
+                   'gewicht_pro_exportkarton')
+
+
+def _packstueck_gewicht(menge, produkte_pro_exportkarton, gewicht_pro_exportkarton):
+    """Gewicht des schwersten Packstücks eines Items, wie AbstractItem.max_packstueck_gewicht."""
+    if menge >= produkte_pro_exportkarton:
+        return gewicht_pro_exportkarton
+    return (gewicht_pro_exportkarton / produkte_pro_exportkarton) * menge
+
+
+class Lieferungsspalten(object):
+    """Spaltenweise Darstellung der Items einer Menge von Lieferungen.
+
+    Die Items aller Lieferungen liegen hintereinander in je einem array('d') pro Attribut. `offsets`
+    enthält für jede Lieferung den Index ihres ersten Items, plus einen Eintrag für das Ende.
+
+    Eine Spalte wird erst geladen, wenn eine Kennzahl sie braucht. Wie bei der Objekt-API müssen die
+    Items also nur die Attribute haben, die für die abgefragten Kennzahlen nötig sind.
+    """
+
+    def __init__(self, lieferungen):
+        items = []
+        offsets = [0]
+        for lieferung in lieferungen:
+            items.extend(lieferung.itemlist)
+            offsets.append(len(items))
+        self.offsets = array('l', offsets)
+        self.items = items
+
+    def __getattr__(self, attribute):
+        """Lädt die Spalte eines Item-Attributs beim ersten Zugriff."""
+        if attribute not in ITEM_ATTRIBUTES:
+            raise AttributeError(attribute)
+        spalte = array('d', map(operator.attrgetter(attribute), self.items))
+        setattr(self, attribute, spalte)
+        return spalte
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _summen(self, spalte):
+        """Summiert eine Item-Spalte pro Lieferung."""
+        offsets = self.offsets
+        return [sum(spalte[start:end]) for start, end in zip(offsets, offsets[1:])]
+
+    def _maxima(self, spalte):
+        """Maximum einer Item-Spalte pro Lieferung, 0 bei Lieferungen ohne Items."""
+        offsets = self.offsets
+        return [max(spalte[start:end]) if end > start else 0 for start, end in zip(offsets, offsets[1:])]
+
+    @property
+    def volumen(self):
+        """Returns the volume of each Lieferung in m^3."""
+        return self._summen(array('d', map(operator.mul, self.menge, self.einzelvolumen)))
+
+    @property
+    def gewicht(self):
+        """Returns the weight of each Lieferung in g."""
+        return self._summen(array('d', map(operator.mul, self.menge, self.einzelgewicht)))
+
+    @property
+    def paletten(self):
+        """Returns the number of pallets of each Lieferung."""
+        return self._summen(array('d', map(operator.truediv, self.menge, self.palettenfaktor)))
+
+    @property
+    def versandpaletten(self):
+        """Returns the number of pallets to be shipped for each Lieferung."""
+        return [math.ceil(paletten) for paletten in self.paletten]
+
+    @property
+    def picks(self):
+        """Returns the number of estimated picks for each Lieferung."""
+        picks = map(math.ceil, map(operator.truediv, self.menge, self.palettenfaktor))
+        return self._summen(array('d', picks))
+
+    @property
+    def export_kartons(self):
+        """Returns the estimated number of export packages of each Lieferung as a float."""
+        return self._summen(array('d', map(operator.truediv, self.menge, self.produkte_pro_exportkarton)))
+
+    @property
+    def max_packstueck_gewicht(self):
+        """Returns the highest package weight of each Lieferung in g."""
+        gewichte = starmap(_packstueck_gewicht, zip(self.menge, self.produkte_pro_exportkarton,
+                                                    self.gewicht_pro_exportkarton))
+        return self._maxima(array('d', gewichte))
+
+    @property
+    def kep(self):
+        """Entscheidet für jede Lieferung, ob sie mit einem Paketdienstleister verschickt werden kann.
+
+        Wie bei AbstractLieferung.kep wird das Packstückgewicht nur für Lieferungen mit höchstens 10
+        Kartons gebraucht. Nur deren Items müssen gewicht_pro_exportkarton haben."""
+        kartons = self.export_kartons
+        offsets = self.offsets
+        items = self.items
+        menge = self.menge
+        produkte = self.produkte_pro_exportkarton
+        kep = []
+        for index, anzahl in enumerate(kartons):
+            if anzahl > 10:
+                kep.append(False)
+                continue
+            gewichte = [_packstueck_gewicht(menge[i], produkte[i], float(items[i].gewicht_pro_exportkarton))
+                        for i in range(offsets[index], offsets[index + 1])]
+            kep.append(max(gewichte or [0]) <= 31500)
+        return kep
+
+    def kennzahlen(self):
+        """Returns a dict mapping each KPI name to a list with one value per Lieferung."""
+        paletten = self.paletten
+        return dict(volumen=self.volumen, gewicht=self.gewicht, paletten=paletten,
+                    versandpaletten=[math.ceil(x) for x in paletten], picks=self.picks, kep=self.kep)
+
+
+class LieferungsspaltenTests(unittest.TestCase):
+    """Compares the columnar KPIs with the object API."""
+
+    def test_gleiche_ergebnisse(self):
+        """All KPIs have to match the values computed by AbstractLieferung."""
+        import random
+        from pyshipping.shipment import AbstractItem, AbstractLieferung
+        random.seed(26)
+        lieferungen = []
+        for _ in range(200):
+            lieferung = AbstractLieferung()
+            for _ in range(random.randint(0, 6)):
+                item = AbstractItem()
+                item.menge = random.randint(1, 400)
+                item.einzelgewicht = random.randint(10, 9000)
+                item.einzelvolumen = random.randint(100, 20000)
+                item.palettenfaktor = random.randint(10, 200)
+                item.produkte_pro_exportkarton = random.randint(1, 12)
+                item.gewicht_pro_exportkarton = item.einzelgewicht * item.produkte_pro_exportkarton
+                lieferung.itemlist.append(item)
+            lieferungen.append(lieferung)
+        spalten = Lieferungsspalten(lieferungen)
+        self.assertEqual(len(spalten), 200)
+        kennzahlen = spalten.kennzahlen()
+        for index, lieferung in enumerate(lieferungen):
+            self.assertEqual(kennzahlen['volumen'][index], lieferung.volumen)
+            self.assertEqual(kennzahlen['gewicht'][index], lieferung.gewicht)
+            self.assertEqual(kennzahlen['paletten'][index], lieferung.paletten)
+            self.assertEqual(kennzahlen['versandpaletten'][index], lieferung.versandpaletten)
+            self.assertEqual(kennzahlen['picks'][index], lieferung.picks)
+            self.assertEqual(kennzahlen['kep'][index], lieferung.kep)
+            self.assertEqual(spalten.max_packstueck_gewicht[index], lieferung.max_packstueck_gewicht)
+
+    def test_fehlende_attribute(self):
+        """Items without gewicht_pro_exportkarton work for the KPIs which do not need it."""
+        from pyshipping.shipment import AbstractItem, AbstractLieferung
+        lieferungen = []
+        for menge in (5, 400):
+            item = AbstractItem()
+            item.menge = menge
+            item.einzelgewicht = 200
+            item.einzelvolumen = 1000
+            item.palettenfaktor = 80
+            item.produkte_pro_exportkarton = 4
+            lieferung = AbstractLieferung()
+            lieferung.itemlist.append(item)
+            lieferungen.append(lieferung)
+        spalten = Lieferungsspalten(lieferungen)
+        self.assertEqual(spalten.volumen, [lieferung.volumen for lieferung in lieferungen])
+        self.assertEqual(spalten.gewicht, [lieferung.gewicht for lieferung in lieferungen])
+        self.assertEqual(spalten.picks, [lieferung.picks for lieferung in lieferungen])
+        self.assertEqual(spalten.paletten, [lieferung.paletten for lieferung in lieferungen])
+        self.assertEqual(Lieferungsspalten(lieferungen[1:]).kep, [lieferungen[1].kep])
+        # only Lieferungen with at most 10 cartons need the weights
+        item = AbstractItem()
+        item.menge, item.einzelgewicht, item.einzelvolumen, item.palettenfaktor = 5, 200, 1000, 80
+        item.produkte_pro_exportkarton, item.gewicht_pro_exportkarton = 4, 800
+        lieferung = AbstractLieferung()
+        lieferung.itemlist.append(item)
+        gemischt = [lieferungen[1], lieferung, AbstractLieferung()]
+        self.assertEqual(Lieferungsspalten(gemischt).kep, [lieferung.kep for lieferung in gemischt])
+        self.assertRaises(AttributeError, getattr, lieferungen[0], 'kep')
+        self.assertRaises(AttributeError, getattr, spalten, 'kep')
+
+    def test_leer(self):
+        """Lieferungen without items."""
+        from pyshipping.shipment import AbstractLieferung
+        spalten = Lieferungsspalten([AbstractLieferung(), AbstractLieferung()])
+        self.assertEqual(spalten.kennzahlen(), dict(volumen=[0, 0], gewicht=[0, 0], paletten=[0, 0],
+                                                    versandpaletten=[0, 0], picks=[0, 0],
+                                                    kep=[True, True]))
+
+
+if __name__ == '__main__':
+    unittest.main()